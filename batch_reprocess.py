@@ -0,0 +1,315 @@
+"""
+Batch reprocessing CLI for backfilling chapters and summaries.
+
+Lists transcripts/*.json under a prefix (in S3 or a local directory) and runs the
+chapter_generator and summary_generator logic for each transcript in a process pool.
+Completed transcripts are appended to a checkpoint manifest so an interrupted
+backfill can be resumed by running the same command again.
+
+Examples:
+    python batch_reprocess.py s3://my-processed-transcripts-output --workers 8 --gemini-rpm 120
+    python batch_reprocess.py s3://my-processed-transcripts-output/transcripts/transcribe_USER --stages summaries
+    python batch_reprocess.py ./local_output --skip-db --dry-run
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from gemini_client import GeminiClient
+from chapter_generator import context_cache_readers, create_transcript_context, parse_transcript_key
+from summary_generator import get_summary_store
+from pipeline import (
+    TRANSCRIPTS_PREFIX,
+    LocalStorage,
+    S3Storage,
+    prepare_transcript,
+    run_chapters_stage,
+    run_summary_stage,
+)
+
+STAGES = ('chapters', 'summaries')
+
+def parse_location(location):
+    """
+    Split a source location into a storage description and a key prefix.
+
+    Args:
+        location: s3://bucket[/prefix] or a local directory path
+
+    Returns:
+        tuple: (kind, root, prefix) where kind is 's3' or 'local'
+    """
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return 's3', bucket, prefix or TRANSCRIPTS_PREFIX
+    return 'local', location, TRANSCRIPTS_PREFIX
+
+def open_storage(kind, root):
+    if kind == 's3':
+        return S3Storage(root)
+    return LocalStorage(root)
+
+def list_transcript_keys(storage, prefix):
+    """List transcript JSON keys under the prefix, matching the chapter generator's filter."""
+    return [
+        key for key in storage.list_keys(prefix)
+        if key.startswith(TRANSCRIPTS_PREFIX) and key.endswith('.json')
+    ]
+
+class RateLimiter:
+    """
+    Space out calls evenly so that all processes together stay under a requests-per-minute budget.
+
+    The next free slot is kept in a multiprocessing.Value, so one limiter shared with
+    the pool initializer enforces a single global rate across every worker process.
+    """
+
+    def __init__(self, requests_per_minute, next_slot=None):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0
+        self.next_slot = next_slot if next_slot is not None else multiprocessing.Value('d', 0.0)
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.next_slot.get_lock():
+            now = time.time()
+            slot = max(now, self.next_slot.value)
+            self.next_slot.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class RateLimitedGeminiClient:
+    """Wrap a GeminiClient so every API request, including cache management, first takes a slot from the rate limiter."""
+
+    def __init__(self, gemini, rate_limiter):
+        self.gemini = gemini
+        self.rate_limiter = rate_limiter
+
+    def generate_content(self, *args, **kwargs):
+        self.rate_limiter.acquire()
+        return self.gemini.generate_content(*args, **kwargs)
+
+    def create_cached_context(self, *args, **kwargs):
+        self.rate_limiter.acquire()
+        return self.gemini.create_cached_context(*args, **kwargs)
+
+    def delete_cached_context(self, *args, **kwargs):
+        self.rate_limiter.acquire()
+        return self.gemini.delete_cached_context(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.gemini, name)
+
+# Per-process state, populated once by init_worker so clients are reused across transcripts
+_storage = None
+_gemini = None
+_update_db = True
+
+def init_worker(kind, root, requests_per_minute, next_slot, update_db=True):
+    """Process pool initializer: create the storage and Gemini clients shared by all tasks in this process."""
+    global _storage, _gemini, _update_db
+    _storage = open_storage(kind, root)
+    _gemini = RateLimitedGeminiClient(GeminiClient(), RateLimiter(requests_per_minute, next_slot))
+    _update_db = update_db
+
+def regenerate_chapters(transcript_json, user_id, video_id, update_status, cached_content=None):
+    """Regenerate chapters and the plain transcript for one video and store them."""
+    run_chapters_stage(_storage, transcript_json, user_id, video_id, gemini=_gemini, cached_content=cached_content,
+                       update_db=_update_db, update_status=update_status)
+
+def regenerate_summaries(transcript_json, user_id, video_id, cached_content=None):
+    """Regenerate the short and long summaries for one video and store them."""
+    store = get_summary_store()
+    for summary_type in ('short', 'long'):
+        run_summary_stage(transcript_json, user_id, video_id, summary_type, gemini=_gemini,
+                          cached_content=cached_content, store=store, update_db=_update_db)
+
+def process_transcript(key, stages):
+    """
+    Run the selected stages for a single transcript. Executed inside a pool worker.
+
+    When more than one request will read the transcript, it is cached in Gemini once and
+    shared by those requests.
+
+    Args:
+        key: Transcript object key (transcripts/transcribe_USER_VIDEO_TIMESTAMP.json)
+        stages: Sequence of stage names to run
+
+    Returns:
+        dict: Manifest entry describing the outcome
+    """
+    start = time.time()
+    cached_content = None
+    try:
+        user_id, video_id = parse_transcript_key(key)
+        transcript_json = json.loads(_storage.read_text(key))
+
+        # One chapters request, and a short and a long summary request unless they are hierarchical
+        readers = context_cache_readers(transcript_json['results']['transcripts'][0]['transcript'],
+                                        chapters='chapters' in stages, summaries=2 if 'summaries' in stages else 0)
+        if readers > 1:
+            _, detailed_transcript_text, _ = prepare_transcript(transcript_json)
+            cached_content = create_transcript_context(detailed_transcript_text, gemini=_gemini)
+
+        if 'chapters' in stages:
+            regenerate_chapters(transcript_json, user_id, video_id, update_status='summaries' in stages,
+                                cached_content=cached_content)
+        if 'summaries' in stages:
+            regenerate_summaries(transcript_json, user_id, video_id, cached_content=cached_content)
+
+        status, error = 'done', None
+    except Exception as e:
+        status, error = 'failed', str(e)
+    finally:
+        if cached_content:
+            try:
+                _gemini.delete_cached_context(cached_content)
+            except Exception:
+                pass  # The cache expires on its own TTL
+
+    return {
+        'key': key,
+        'stages': list(stages),
+        'status': status,
+        'error': error,
+        'elapsed_seconds': round(time.time() - start, 2),
+        'finished_at': datetime.utcnow().isoformat() + 'Z',
+    }
+
+def load_completed_keys(manifest_path, stages):
+    """
+    Read the checkpoint manifest and return keys for which every requested stage is done.
+
+    Args:
+        manifest_path: Path to the JSON lines manifest
+        stages: Stages requested for this run
+
+    Returns:
+        set: Transcript keys that can be skipped
+    """
+    done_stages = {}
+    if not os.path.exists(manifest_path):
+        return set()
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A partially written last line from an interrupted run
+                continue
+            if entry.get('status') == 'done':
+                done_stages.setdefault(entry['key'], set()).update(entry.get('stages', []))
+
+    return {key for key, completed in done_stages.items() if set(stages) <= completed}
+
+def format_progress(completed, failed, total, started_at):
+    elapsed = time.time() - started_at
+    processed = completed + failed
+    per_minute = processed / elapsed * 60 if elapsed > 0 else 0
+    remaining = total - processed
+    eta_minutes = remaining / per_minute if per_minute else 0
+    return (f"[{processed}/{total}] done={completed} failed={failed} "
+            f"rate={per_minute:.1f}/min elapsed={elapsed / 60:.1f}min eta={eta_minutes:.1f}min")
+
+def run_batch(keys, stages, kind, root, manifest_path, workers, requests_per_minute, update_db=True, report_every=10):
+    """
+    Process transcripts in a process pool, appending each outcome to the manifest.
+
+    Returns:
+        tuple: (completed_count, failed_count)
+    """
+    next_slot = multiprocessing.Value('d', 0.0)
+    completed = failed = 0
+    started_at = time.time()
+
+    with open(manifest_path, 'a', encoding='utf-8') as manifest, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                initargs=(kind, root, requests_per_minute, next_slot, update_db)) as executor:
+        futures = {executor.submit(process_transcript, key, stages): key for key in keys}
+        try:
+            for future in as_completed(futures):
+                entry = future.result()
+                manifest.write(json.dumps(entry) + '\n')
+                manifest.flush()
+
+                if entry['status'] == 'done':
+                    completed += 1
+                else:
+                    failed += 1
+                    print(f"Failed {entry['key']}: {entry['error']}")
+
+                if (completed + failed) % report_every == 0:
+                    print(format_progress(completed, failed, len(keys), started_at))
+        except KeyboardInterrupt:
+            print("Interrupted, cancelling pending transcripts. Re-run the same command to resume.")
+            for future in futures:
+                future.cancel()
+            raise
+
+    print(format_progress(completed, failed, len(keys), started_at))
+    return completed, failed
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocess transcripts to regenerate chapters and summaries.")
+    parser.add_argument('location', help="s3://bucket[/prefix] or a local directory containing transcripts/")
+    parser.add_argument('--prefix', default=None,
+                        help="Key prefix to list (default: transcripts/ or the path of an s3:// location)")
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help="Comma separated stages to run: chapters, summaries (default: both)")
+    parser.add_argument('--manifest', default='reprocess_manifest.jsonl',
+                        help="Checkpoint manifest path; transcripts already done in it are skipped")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes")
+    parser.add_argument('--gemini-rpm', type=float, default=float(os.environ.get('GEMINI_RPM', 60)),
+                        help="Global Gemini requests per minute across all workers (0 disables the limit)")
+    parser.add_argument('--limit', type=int, default=None, help="Process at most this many transcripts")
+    parser.add_argument('--skip-db', action='store_true', help="Do not write results to Supabase")
+    parser.add_argument('--dry-run', action='store_true', help="List the transcripts that would be processed and exit")
+    parser.add_argument('--report-every', type=int, default=10, help="Print throughput every N transcripts")
+
+    args = parser.parse_args(argv)
+    args.stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = set(args.stages) - set(STAGES)
+    if unknown or not args.stages:
+        parser.error(f"--stages must be a subset of {', '.join(STAGES)}")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    kind, root, prefix = parse_location(args.location)
+    prefix = args.prefix or prefix
+    storage = open_storage(kind, root)
+
+    keys = list_transcript_keys(storage, prefix)
+    completed_keys = load_completed_keys(args.manifest, args.stages)
+    pending = [key for key in keys if key not in completed_keys]
+    skipped = len(keys) - len(pending)
+    if args.limit is not None:
+        pending = pending[:args.limit]
+
+    print(f"Found {len(keys)} transcripts under {storage.describe(prefix)}, "
+          f"{skipped} already done, {len(pending)} to process (stages: {', '.join(args.stages)})")
+
+    if args.dry_run:
+        for key in pending:
+            print(storage.describe(key))
+        return 0
+
+    if not pending:
+        return 0
+
+    _, failed = run_batch(pending, args.stages, kind, root, args.manifest, args.workers,
+                          args.gemini_rpm, update_db=not args.skip_db, report_every=args.report_every)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,8 +7,31 @@ import re
 from datetime import datetime, timedelta
 from urllib.parse import urlparse, unquote_plus
 from gemini_client import GeminiClient
+from job_queue import PIPELINE_STAGES, open_queue
+from stage_state import StageState, get_stage_state_store, hash_text
+from summary_generator import summary_types_for, use_hierarchical_summary
 from supabase_client import update_chapters, update_transcript
 
+# Returned when Gemini fails so the pipeline can still progress
+FALLBACK_CHAPTERS = "00:00 Introduction\n01:00 Main Content"
+
+# Gemini rejects caches below a per-model minimum token count, so short transcripts are always
+# sent inline. Models are matched by prefix; others use the default.
+CONTEXT_CACHE_MIN_TOKENS = (
+    ('gemini-1.5', 32768),
+    ('gemini-2.5-flash', 1024),
+    ('gemini-2.5-pro', 4096),
+)
+DEFAULT_CONTEXT_CACHE_MIN_TOKENS = 4096
+# Rough characters per token, used to compare transcript length with the cache minimum
+CHARS_PER_TOKEN = 4
+# Must outlive the delayed summary events scheduled after chapter generation
+CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get("GEMINI_CACHE_TTL_SECONDS", "900"))
+# Transcript JSON files above this size are processed by the ECS pipeline worker when WORKER_QUEUE_URL is set
+WORKER_ROUTING_MIN_BYTES = int(os.environ.get("WORKER_ROUTING_MIN_BYTES", str(3 * 1024 * 1024)))
+# Largest transcript embedded in a summary event; EventBridge rejects entries over 256 KB
+EVENT_TRANSCRIPT_MAX_BYTES = 200 * 1024
+
 def format_time(seconds):
     """Convert seconds to HH:MM:SS format"""
     m, s = divmod(int(seconds), 60)
@@ -73,21 +96,66 @@ def format_transcript_with_detailed_timestamps(items, interval_seconds=10):
     
     return ''.join(result).strip()
 
-def generate_chapters_with_gemini(detailed_transcript_text, video_duration_minutes):
+def estimate_video_duration_minutes(items):
     """
-    Use Gemini to generate chapters based on transcript with timestamps.
+    Estimate the video duration from the last pronunciation item.
     
     Args:
-        detailed_transcript_text: The transcript text with timestamps.
-        video_duration_minutes: Estimated duration of the video in minutes.
+        items: List of transcript items from AWS Transcribe JSON.
         
     Returns:
-        String containing generated chapter list.
+        int: Duration in whole minutes (minimum 1).
     """
-    try:
-        gemini = GeminiClient()
+    video_duration_seconds = 0
+    for item in reversed(items):
+        if item.get('type') == 'pronunciation' and 'end_time' in item:
+            video_duration_seconds = float(item.get('end_time', 0))
+            break
+    
+    video_duration_minutes = round(video_duration_seconds / 60)
+    if video_duration_minutes < 1:
+        video_duration_minutes = 1  # Minimum 1 minute
+    return video_duration_minutes
+
+def parse_transcript_key(key):
+    """
+    Extract user_id and video_id from a transcript object key.
+    
+    Args:
+        key: Key such as transcripts/transcribe_USER_VIDEO_TIMESTAMP.json
+        
+    Returns:
+        tuple: (user_id, video_id)
+        
+    Raises:
+        ValueError: If the filename does not follow the transcription job naming scheme
+    """
+    base_name = os.path.basename(key).split('.')[0]
+    match = re.match(r'transcribe_([^_]+)_([^_]+)_\d+$', base_name)
+    
+    if not match:
+        raise ValueError(f"Could not extract user_id and video_id from filename: {base_name}")
+        
+    return match.group(1), match.group(2)
+
+def build_chapters_prompt(video_duration_minutes, detailed_transcript_text=None):
+    """
+    Build the chapter generation prompt.
+    
+    Args:
+        video_duration_minutes: Estimated duration of the video in minutes.
+        detailed_transcript_text: The transcript text with timestamps. If omitted, the prompt
+            refers to a transcript already supplied as cached context.
         
-        prompt = f"""Objective: Generate meaningful video chapters based on the provided transcript, prioritizing logical content structure over arbitrary time intervals.
+    Returns:
+        str: The prompt text.
+    """
+    if detailed_transcript_text is None:
+        transcript_section = "The transcript is provided in the context above."
+    else:
+        transcript_section = f"Here is the transcript:\n{detailed_transcript_text}"
+    
+    return f"""Objective: Generate meaningful video chapters based on the provided transcript, prioritizing logical content structure over arbitrary time intervals.
 
 **Context:**
 You are analyzing a transcript for a video that is approximately {video_duration_minutes} minutes long. Your goal is to create chapter markers that significantly enhance viewer navigation by identifying the distinct thematic sections, topic shifts, or key stages within the content.
@@ -126,17 +194,105 @@ You are analyzing a transcript for a video that is approximately {video_duration
 *   All chapter titles MUST be in the same language as the transcript.
 *   Do NOT include brackets, extra words, explanations, notes, or any text before or after the chapter list.
 
-Here is the transcript:
-{detailed_transcript_text}"""
+{transcript_section}"""
+
+def context_cache_min_chars(model_name):
+    """
+    Shortest transcript worth caching for a model.
+    
+    Args:
+        model_name: The Gemini model name, with or without the models/ prefix
+        
+    Returns:
+        int: Minimum length in characters, or None if the model cannot be cached at all.
+        Only stable model versions can be cached, not aliases such as gemini-1.5-pro-latest.
+    """
+    model_name = model_name.split('/')[-1]
+    if model_name.endswith('-latest'):
+        return None
+    
+    min_tokens = next((tokens for prefix, tokens in CONTEXT_CACHE_MIN_TOKENS if model_name.startswith(prefix)),
+                      DEFAULT_CONTEXT_CACHE_MIN_TOKENS)
+    return min_tokens * CHARS_PER_TOKEN
+
+def context_cache_readers(full_transcript_text, chapters=True, summaries=2):
+    """
+    Count the Gemini requests that would read a cached transcript context.
+    
+    Hierarchical summaries send their sections inline and never read the cache, so summaries
+    only count for transcripts summarised in a single prompt. Caching pays off only when
+    this is more than one.
+    
+    Args:
+        full_transcript_text: The plain transcript text
+        chapters: Whether chapters will be generated
+        summaries: Number of summaries that will be generated
+    """
+    summary_readers = 0 if use_hierarchical_summary(full_transcript_text) else summaries
+    return int(chapters) + summary_readers
+
+def create_transcript_context(detailed_transcript_text, gemini=None):
+    """
+    Cache the timestamped transcript in Gemini so the chapter and summary requests
+    for a video reuse it instead of each uploading the full transcript.
+    
+    Args:
+        detailed_transcript_text: The transcript text with timestamps.
+        gemini: Optional GeminiClient to reuse. A new client is created if not provided.
+        
+    Returns:
+        The cache name, or None if the transcript is too short to cache for the configured
+        model, the model cannot be cached, or caching failed. Callers then send the transcript
+        inline as before.
+    """
+    try:
+        gemini = gemini or GeminiClient()
+        min_chars = context_cache_min_chars(gemini.model_name)
+        if min_chars is None or len(detailed_transcript_text) < min_chars:
+            return None
+        
+        cached_content = gemini.create_cached_context(
+            f"Transcript:\n{detailed_transcript_text}",
+            ttl_seconds=CONTEXT_CACHE_TTL_SECONDS,
+        )
+        print(f"Cached transcript context: {cached_content}")
+        return cached_content
+    except Exception as e:
+        print(f"Could not cache transcript context, sending transcript inline: {str(e)}")
+        return None
+
+def generate_chapters_with_gemini(detailed_transcript_text, video_duration_minutes, gemini=None, cached_content=None):
+    """
+    Use Gemini to generate chapters based on transcript with timestamps.
+    
+    Args:
+        detailed_transcript_text: The transcript text with timestamps.
+        video_duration_minutes: Estimated duration of the video in minutes.
+        gemini: Optional GeminiClient to reuse. A new client is created if not provided.
+        cached_content: Optional cache name from create_transcript_context holding the transcript.
+        
+    Returns:
+        String containing generated chapter list.
+    """
+    try:
+        gemini = gemini or GeminiClient()
+        
+        if cached_content:
+            try:
+                response = gemini.generate_content(build_chapters_prompt(video_duration_minutes), cached_content=cached_content)
+            except Exception as e:
+                print(f"Cached context unavailable, sending transcript inline: {str(e)}")
+                response = gemini.generate_content(build_chapters_prompt(video_duration_minutes, detailed_transcript_text))
+        else:
+            response = gemini.generate_content(build_chapters_prompt(video_duration_minutes, detailed_transcript_text))
 
-        response = gemini.generate_content(prompt)
         print("Generated chapters:")
         print(response)
         return response
         
     except Exception as e:
         print(f"Error during chapter generation: {str(e)}")
-        return "00:00 Introduction\n01:00 Main Content"
+        return FALLBACK_CHAPTERS
 
 def extract_plain_transcript(transcript_json):
     """
@@ -153,16 +309,23 @@ def extract_plain_transcript(transcript_json):
         return transcript_json['results']['transcripts'][0]['transcript']
     return ""
 
-def schedule_summary_generation(user_id, video_id, transcript_text, summary_type, delay_minutes=0):
+def schedule_summary_generation(user_id, video_id, transcript_text, summary_type, delay_minutes=0, cached_content=None,
+                                transcript_bucket=None, transcript_key=None):
     """
     Schedule a summary generation event using EventBridge.
     
     Args:
         user_id: The user ID
         video_id: The video ID
-        transcript_text: The plain transcript text
-        summary_type: Either 'short' or 'long'
-        delay_minutes: Number of minutes to delay the event
+        transcript_text: The plain transcript text, or None to have the summary function load
+            it from transcript_key
+        summary_type: 'short', 'long' or 'both' (one invocation produces both summaries)
+        delay_minutes: Minutes added to the event timestamp. EventBridge delivers the event
+            immediately regardless, so this does not order the summary invocations.
+        cached_content: Optional Gemini cache name holding the transcript
+        transcript_bucket: Bucket of the transcript JSON
+        transcript_key: Key of the transcript JSON, so the summary function can load the
+            timestamped items or a transcript too large to embed in the event
     """
     try:
         events = boto3.client('events')
@@ -175,9 +338,16 @@ def schedule_summary_generation(user_id, video_id, transcript_text, summary_type
             'user_id': user_id,
             'video_id': video_id,
             'transcript_text': transcript_text,
-            'summary_type': summary_type
+            'summary_type': summary_type,
+            'cached_content': cached_content,
+            'transcript_bucket': transcript_bucket,
+            'transcript_key': transcript_key
         }
         
+        # EventBridge entries are limited to 256 KB, so very long transcripts are loaded from S3 instead
+        if transcript_key and transcript_text is not None and len(transcript_text.encode('utf-8')) > EVENT_TRANSCRIPT_MAX_BYTES:
+            event_detail['transcript_text'] = None
+        
         # Put the event
         response = events.put_events(
             Entries=[
@@ -198,6 +368,76 @@ def schedule_summary_generation(user_id, video_id, transcript_text, summary_type
         print(f"Error scheduling summary generation: {str(e)}")
         raise
 
+def load_transcript(s3, bucket, key):
+    """
+    Download a transcript JSON and derive the texts the pipeline steps use.
+    
+    Args:
+        s3: boto3 S3 client
+        bucket: The transcript bucket
+        key: The transcript object key
+        
+    Returns:
+        dict: 'full_text' (for summaries), 'plain_text' (stored transcript), 'detailed_text'
+        (timestamped, for chapters) and 'duration_minutes'
+    """
+    transcript_file = s3.get_object(Bucket=bucket, Key=key)
+    transcript_content = transcript_file['Body'].read().decode('utf-8')
+    transcript_json = json.loads(transcript_content)
+    
+    # Extract the full text from the transcript (for fallback)
+    full_transcript_text = transcript_json['results']['transcripts'][0]['transcript']
+    
+    # Extract items with timestamps for detailed formatting
+    items = transcript_json['results']['items']
+    
+    # Determine video duration from the last timestamp in the items
+    video_duration_minutes = estimate_video_duration_minutes(items)
+        
+    print(f"Estimated video duration: {video_duration_minutes} minutes")
+    
+    # Format transcript with detailed timestamps
+    detailed_transcript_text = format_transcript_with_detailed_timestamps(items, interval_seconds=10)
+    
+    if not detailed_transcript_text:
+        print("Warning: Could not create detailed transcript with timestamps.")
+        print("Falling back to raw transcript text (no timestamps).")
+        detailed_transcript_text = full_transcript_text
+        
+    transcript_sample = detailed_transcript_text[:200] + "..." if len(detailed_transcript_text) > 200 else detailed_transcript_text
+    print(f"Successfully retrieved and formatted transcript ({len(detailed_transcript_text)} chars)")
+    print(f"Sample with timestamps: {transcript_sample}")
+    
+    return {
+        'full_text': full_transcript_text,
+        'plain_text': extract_plain_transcript(transcript_json),
+        'detailed_text': detailed_transcript_text,
+        'duration_minutes': video_duration_minutes,
+    }
+
+def route_to_worker(bucket, key, object_size):
+    """
+    Send a heavy transcript to the pipeline worker queue instead of processing it in Lambda.
+    
+    Args:
+        bucket: The transcript bucket
+        key: The transcript object key
+        object_size: Size of the transcript JSON in bytes
+        
+    Returns:
+        bool: True if the job was queued, False if it should be processed here
+    """
+    if object_size < WORKER_ROUTING_MIN_BYTES:
+        return False
+    
+    queue = open_queue()
+    if queue is None:
+        return False
+    
+    message_id = queue.send({'bucket': bucket, 'key': key, 'stages': list(PIPELINE_STAGES)})
+    print(f"Routed {object_size} byte transcript to pipeline worker (message {message_id})")
+    return True
+
 def lambda_handler(event, context):
     try:
         s3 = boto3.client('s3')
@@ -219,99 +459,128 @@ def lambda_handler(event, context):
                 'body': 'Not a transcript JSON file'
             }
         
-        # Get the transcript file
-        transcript_file = s3.get_object(Bucket=bucket, Key=decoded_key)
-        transcript_content = transcript_file['Body'].read().decode('utf-8')
-        transcript_json = json.loads(transcript_content)
-        
-        # Extract the full text from the transcript (for fallback)
-        full_transcript_text = transcript_json['results']['transcripts'][0]['transcript']
-        
-        # Extract items with timestamps for detailed formatting
-        items = transcript_json['results']['items']
+        # Heavy transcripts go to the ECS worker, which has more memory and no 300 s limit
+        object_size = event['Records'][0]['s3']['object'].get('size', 0)
+        if route_to_worker(bucket, decoded_key, object_size):
+            return {
+                'statusCode': 200,
+                'body': 'Transcript routed to pipeline worker'
+            }
         
-        # Determine video duration from the last timestamp in the items
-        video_duration_seconds = 0
-        for item in reversed(items):
-            if item.get('type') == 'pronunciation' and 'end_time' in item:
-                video_duration_seconds = float(item.get('end_time', 0))
-                break
+        # Extract user_id and video_id from the filename
+        user_id, video_id = parse_transcript_key(key)
+        
+        # Stage state lets a retry skip the steps that already succeeded
+        state = StageState(get_stage_state_store(), user_id, video_id)
+        transcript_etag = event['Records'][0]['s3']['object'].get('eTag')
+        if state.matches_source(decoded_key, transcript_etag) and all(
+                state.is_done('events', summary_type) for summary_type in ('short', 'long')):
+            print(f"All stages already completed for video {video_id}, nothing to do")
+            return {
+                'statusCode': 200,
+                'body': "Processing already complete."
+            }
         
-        video_duration_minutes = round(video_duration_seconds / 60)
-        if video_duration_minutes < 1:
-            video_duration_minutes = 1  # Minimum 1 minute
+        # A retry of the same transcript object trusts the stored hash and chapters, and only
+        # loads the transcript if a step that needs its text is still pending
+        transcript = None
+        if not (state.matches_source(decoded_key, transcript_etag) and state.get('chapters')):
+            transcript = load_transcript(s3, bucket, decoded_key)
+            state.start_transcript(decoded_key, transcript_etag, hash_text(transcript['detailed_text']))
+        
+        chapters = state.get('chapters')
+        cached_content = state.get('cached_content')
+        if chapters:
+            print("Reusing chapters generated by a previous attempt")
+        else:
+            # Upload the transcript to Gemini once when the chapters and summary requests can share it
+            if context_cache_readers(transcript['full_text']) > 1:
+                cached_content = create_transcript_context(transcript['detailed_text'])
+            else:
+                cached_content = None
+            state.set('cached_content', cached_content)
             
-        print(f"Estimated video duration: {video_duration_minutes} minutes")
-        
-        # Format transcript with detailed timestamps
-        detailed_transcript_text = format_transcript_with_detailed_timestamps(items, interval_seconds=10)
-        
-        if not detailed_transcript_text:
-            print("Warning: Could not create detailed transcript with timestamps.")
-            print("Falling back to raw transcript text (no timestamps).")
-            detailed_transcript_text = full_transcript_text
+            # Generate chapters using Gemini
+            chapters = generate_chapters_with_gemini(transcript['detailed_text'], transcript['duration_minutes'],
+                                                     cached_content=cached_content)
             
-        transcript_sample = detailed_transcript_text[:200] + "..." if len(detailed_transcript_text) > 200 else detailed_transcript_text
-        print(f"Successfully retrieved and formatted transcript ({len(detailed_transcript_text)} chars)")
-        print(f"Sample with timestamps: {transcript_sample}")
-        
-        # Generate chapters using Gemini
-        chapters = generate_chapters_with_gemini(detailed_transcript_text, video_duration_minutes)
+            # Keep placeholder chapters out of the record so a retry asks Gemini again
+            if chapters != FALLBACK_CHAPTERS:
+                state.set('chapters', chapters)
         
-        # Extract plain transcript text
-        plain_transcript = extract_plain_transcript(transcript_json)
+        # Writes of placeholder chapters are not recorded, so a retry that gets real chapters rewrites them
+        chapters_final = chapters != FALLBACK_CHAPTERS
         
-        # Extract user_id and video_id from the filename
-        base_name = os.path.basename(key).split('.')[0]
-        match = re.match(r'transcribe_([^_]+)_([^_]+)_\d+$', base_name)
-        
-        if not match:
-            raise ValueError(f"Could not extract user_id and video_id from filename: {base_name}")
-            
-        user_id = match.group(1)
-        video_id = match.group(2)
+        # Remember how the summaries are generated, so scheduling them on a retry needs no transcript
+        if transcript is not None and state.get('hierarchical_summaries') is None:
+            state.set('hierarchical_summaries', use_hierarchical_summary(transcript['full_text']))
         
-        # Save chapters to S3
         chapters_output_key = f"chapters/{user_id}/{video_id}_chapters.txt"
         transcript_output_key = f"plain_text/{user_id}/{video_id}_transcript.txt"
         
-        # Ensure directories exist
-        for output_key in [chapters_output_key, transcript_output_key]:
+        events_pending = not all(state.is_done('events', summary_type) for summary_type in ('short', 'long'))
+        if transcript is None and (not state.is_done('s3_writes', transcript_output_key)
+                                   or not state.is_done('db_writes', 'transcript')
+                                   or (events_pending and state.get('hierarchical_summaries') is None)):
+            transcript = load_transcript(s3, bucket, decoded_key)
+        
+        # Save chapters and the plain transcript to S3
+        for output_key in (chapters_output_key, transcript_output_key):
+            if state.is_done('s3_writes', output_key):
+                continue
+            body = chapters if output_key == chapters_output_key else transcript['plain_text']
+            
+            # Ensure directories exist
             if '/' in output_key:
                 directory_path = '/'.join(output_key.split('/')[:-1]) + '/'
                 try:
                     s3.head_object(Bucket=bucket, Key=directory_path)
                 except:
                     s3.put_object(Bucket=bucket, Key=directory_path, Body='')
-        
-        # Save files to S3
-        s3.put_object(Bucket=bucket, Key=chapters_output_key, Body=chapters, ContentType='text/plain')
-        s3.put_object(Bucket=bucket, Key=transcript_output_key, Body=plain_transcript, ContentType='text/plain')
-        
-        print(f"Chapters saved to s3://{bucket}/{chapters_output_key}")
-        print(f"Plain transcript saved to s3://{bucket}/{transcript_output_key}")
+            
+            # Save file to S3
+            s3.put_object(Bucket=bucket, Key=output_key, Body=body, ContentType='text/plain')
+            print(f"Saved s3://{bucket}/{output_key}")
+            if output_key != chapters_output_key or chapters_final:
+                state.mark_done('s3_writes', output_key)
         
         # Update document with transcript
-        try:
-            update_transcript(user_id, video_id, plain_transcript)
-            print("Updated document with transcript text")
-        except Exception as e:
-            print(f"Error updating transcript in Supabase: {str(e)}")
-            raise
+        if not state.is_done('db_writes', 'transcript'):
+            try:
+                update_transcript(user_id, video_id, transcript['plain_text'])
+                state.mark_done('db_writes', 'transcript')
+                print("Updated document with transcript text")
+            except Exception as e:
+                print(f"Error updating transcript in Supabase: {str(e)}")
+                raise
         
         # Update document with chapters and set status to processing_summaries
-        try:
-            update_chapters(user_id, video_id, chapters)
-            print("Updated document with chapters and set status to processing_summaries")
-        except Exception as e:
-            print(f"Error updating Supabase: {str(e)}")
-            raise
-        
-        # Schedule summary generation events
-        # Schedule short summary first
-        schedule_summary_generation(user_id, video_id, full_transcript_text, 'short', delay_minutes=1)
-        # Schedule long summary with 1-minute delay
-        schedule_summary_generation(user_id, video_id, full_transcript_text, 'long', delay_minutes=2)
+        if not state.is_done('db_writes', 'chapters'):
+            try:
+                update_chapters(user_id, video_id, chapters)
+                if chapters_final:
+                    state.mark_done('db_writes', 'chapters')
+                print("Updated document with chapters and set status to processing_summaries")
+            except Exception as e:
+                print(f"Error updating Supabase: {str(e)}")
+                raise
+        
+        # Schedule summary generation events. Hierarchical summaries derive the short summary
+        # from the reduced long one, so a single invocation produces both instead of two
+        # Lambdas summarising every section at the same time. Without the transcript loaded,
+        # the summary function reads it from transcript_key.
+        if state.get('hierarchical_summaries'):
+            summary_events = [('both', 1)]
+        else:
+            summary_events = [('short', 1), ('long', 2)]
+        full_transcript_text = transcript['full_text'] if transcript else None
+        for summary_type, delay_minutes in summary_events:
+            if all(state.is_done('events', event_type) for event_type in summary_types_for(summary_type)):
+                continue
+            schedule_summary_generation(user_id, video_id, full_transcript_text, summary_type, delay_minutes=delay_minutes,
+                                        cached_content=cached_content, transcript_bucket=bucket, transcript_key=decoded_key)
+            for event_type in summary_types_for(summary_type):
+                state.mark_done('events', event_type)
         
         return {
             'statusCode': 200,
@@ -17,10 +17,16 @@ pip install --upgrade pip
 pip install --platform manylinux2014_x86_64 --implementation cp --python-version 3.9 --only-binary=:all: -r requirements.txt -t lambda_package/
 
 echo "Copying source code..."
+cp lambda_function.py lambda_package/
+cp fingerprint.py lambda_package/
+cp ingest_api.py lambda_package/
 cp chapter_generator.py lambda_package/
 cp summary_generator.py lambda_package/
 cp gemini_client.py lambda_package/
 cp supabase_client.py lambda_package/
+cp kv_store.py lambda_package/
+cp job_queue.py lambda_package/
+cp stage_state.py lambda_package/
 
 echo "Deactivating virtual environment..."
 deactivate
@@ -0,0 +1,353 @@
+"""
+Acoustic fingerprinting used to detect re-uploads of the same recording.
+
+A fingerprint is a set of spectral-peak landmarks: pairs of prominent spectrogram peaks
+hashed from their two frequencies and time gap, each stored with the time of its first
+peak. Re-encoding, re-exporting or trimming a recording changes its bytes but keeps most
+of these peaks, so two uploads of the same audio share many landmark hashes at a constant
+time offset.
+"""
+import base64
+import json
+import os
+import re
+import subprocess
+import zlib
+import numpy as np
+
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "ffmpeg")
+# Each ffmpeg run is killed after this long, so a stalled read of the media URL cannot use up
+# the 300 s Lambda timeout before transcription starts (a probe and a decode run per upload)
+FFMPEG_TIMEOUT_SECONDS = int(os.environ.get("FFMPEG_TIMEOUT_SECONDS", "60"))
+SAMPLE_RATE = 8000
+FRAME_SIZE = 1024
+HOP_SIZE = 256
+# Neighbourhood (frequency bins, frames) a peak must dominate
+PEAK_NEIGHBORHOOD = (15, 15)
+# Keep at most this many of the strongest peaks per second of audio
+PEAKS_PER_SECOND = 30
+# Pair each anchor peak with this many peaks following it
+FAN_OUT = 5
+# Target zone for pairing, in frames after the anchor
+MAX_PAIR_FRAMES = 63
+# Frequency bins are merged in groups of this size before hashing, so a peak moving to a
+# neighbouring bin after re-encoding still produces the same hash
+BIN_QUANTIZATION = 2
+# Only landmarks whose hash falls in one of this many hash-defined groups are kept. The choice
+# depends only on the hash, so copies of a recording keep the same landmarks, and the index
+# stays this many times smaller.
+LANDMARK_SAMPLING = 4
+# A match is scored by the share of COVERAGE_BLOCK_SECONDS blocks of the query that contain at
+# least MIN_BLOCK_MATCHES landmarks aligned with the indexed recording, so a short shared
+# segment (an intro jingle, a sponsor read) cannot make two different recordings match
+COVERAGE_BLOCK_SECONDS = 2.0
+MIN_BLOCK_MATCHES = 2
+# Recordings whose durations differ by more than this (seconds, or share of the longer one)
+# are never treated as the same recording
+DURATION_TOLERANCE_SECONDS = 10.0
+DURATION_TOLERANCE_RATIO = 0.05
+
+def decode_audio(source, max_seconds=None, sample_rate=SAMPLE_RATE):
+    """
+    Decode the audio track of a media file or URL to mono float samples with ffmpeg.
+
+    Args:
+        source: Local path or URL (e.g. a presigned S3 URL) of the media
+        max_seconds: Only decode this many seconds from the start
+        sample_rate: Output sample rate
+
+    Returns:
+        numpy.ndarray: float32 samples in [-1, 1]
+
+    Raises:
+        RuntimeError: If ffmpeg is missing, fails or takes longer than FFMPEG_TIMEOUT_SECONDS
+    """
+    command = [FFMPEG_PATH, '-nostdin', '-loglevel', 'error', '-i', source, '-vn', '-ac', '1',
+               '-ar', str(sample_rate), '-f', 's16le']
+    if max_seconds:
+        command[-2:-2] = ['-t', str(max_seconds)]
+    command.append('-')
+
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+                                timeout=FFMPEG_TIMEOUT_SECONDS)
+    except FileNotFoundError:
+        raise RuntimeError(f"ffmpeg not found at {FFMPEG_PATH}")
+    except subprocess.TimeoutExpired:
+        raise RuntimeError(f"ffmpeg did not finish decoding within {FFMPEG_TIMEOUT_SECONDS} seconds")
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"ffmpeg failed: {e.stderr.decode('utf-8', 'replace').strip()}")
+
+    return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768.0
+
+def media_duration(source):
+    """
+    Read the duration ffmpeg reports for a media file or URL, without decoding it.
+
+    Returns:
+        float: Duration in seconds, or None if ffmpeg does not report one
+
+    Raises:
+        RuntimeError: If ffmpeg is missing or takes longer than FFMPEG_TIMEOUT_SECONDS
+    """
+    try:
+        # With no output file ffmpeg exits with an error after printing the input details
+        result = subprocess.run([FFMPEG_PATH, '-nostdin', '-hide_banner', '-i', source],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=FFMPEG_TIMEOUT_SECONDS)
+    except FileNotFoundError:
+        raise RuntimeError(f"ffmpeg not found at {FFMPEG_PATH}")
+    except subprocess.TimeoutExpired:
+        raise RuntimeError(f"ffmpeg did not read the media within {FFMPEG_TIMEOUT_SECONDS} seconds")
+
+    match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', result.stderr.decode('utf-8', 'replace'))
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def durations_match(first, second):
+    """Whether two recording durations are close enough for the recordings to be the same."""
+    if first is None or second is None:
+        return False
+    tolerance = max(DURATION_TOLERANCE_SECONDS, DURATION_TOLERANCE_RATIO * max(first, second))
+    return abs(first - second) <= tolerance
+
+def _spectrogram(samples):
+    """Log-magnitude STFT with shape (frames, frequency bins)."""
+    if len(samples) < FRAME_SIZE:
+        return np.zeros((0, FRAME_SIZE // 2 + 1), dtype=np.float32)
+    frame_count = 1 + (len(samples) - FRAME_SIZE) // HOP_SIZE
+    indices = np.arange(FRAME_SIZE)[None, :] + HOP_SIZE * np.arange(frame_count)[:, None]
+    frames = samples[indices] * np.hanning(FRAME_SIZE).astype(np.float32)
+    magnitude = np.abs(np.fft.rfft(frames, axis=1)).astype(np.float32)
+    return np.log(magnitude + 1e-6)
+
+def _max_filter(values, size):
+    """Separable moving maximum over a (frames, bins) array, without SciPy."""
+    result = values
+    for axis, width in ((1, size[0]), (0, size[1])):
+        radius = width // 2
+        padded = np.pad(result, [(radius, radius) if a == axis else (0, 0) for a in range(2)],
+                        mode='constant', constant_values=-np.inf)
+        filtered = np.full_like(result, -np.inf)
+        for offset in range(width):
+            window = padded[offset:offset + result.shape[0]] if axis == 0 else padded[:, offset:offset + result.shape[1]]
+            np.maximum(filtered, window, out=filtered)
+        result = filtered
+    return result
+
+def find_peaks(spectrogram):
+    """
+    Return spectral peaks as (frame, bin) arrays, sorted by frame.
+
+    A peak is the maximum of its neighbourhood and stands clearly above the typical level
+    of the spectrogram. Only the strongest PEAKS_PER_SECOND peaks of each one-second block
+    are kept, so the salient tones that survive re-encoding dominate over noise.
+    """
+    if spectrogram.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    local_max = _max_filter(spectrogram, PEAK_NEIGHBORHOOD)
+    threshold = np.median(spectrogram) + 2.0
+    frames, bins = np.nonzero((spectrogram == local_max) & (spectrogram > threshold))
+
+    block_frames = max(1, SAMPLE_RATE // HOP_SIZE)
+    strength = spectrogram[frames, bins]
+    # Sort by block, then strongest first, and keep the first PEAKS_PER_SECOND of each block
+    order = np.lexsort((-strength, frames // block_frames))
+    blocks = (frames // block_frames)[order]
+    rank = np.arange(len(order)) - np.searchsorted(blocks, blocks, side='left')
+    keep = order[rank < PEAKS_PER_SECOND]
+
+    keep = keep[np.argsort(frames[keep], kind='stable')]
+    return frames[keep], bins[keep]
+
+def compute_fingerprint(samples):
+    """
+    Compute the landmark fingerprint of mono samples at SAMPLE_RATE.
+
+    Returns:
+        tuple: (hashes, times) as uint32 arrays of the landmarks kept by LANDMARK_SAMPLING.
+        Each hash packs the quantized anchor bin (10 bits), quantized target bin (10 bits) and
+        frame gap (6 bits); times are anchor frames.
+    """
+    frames, bins = find_peaks(_spectrogram(samples))
+    bins = bins // BIN_QUANTIZATION
+
+    # Candidate targets are the next few peaks after each anchor; keep the first FAN_OUT
+    # that fall inside the target zone
+    candidate_count = FAN_OUT * 3
+    targets = np.arange(len(frames))[:, None] + np.arange(1, candidate_count + 1)[None, :]
+    in_range = targets < len(frames)
+    targets = np.minimum(targets, max(len(frames) - 1, 0))
+    gaps = frames[targets] - frames[:, None] if len(frames) else np.zeros((0, candidate_count), dtype=np.int64)
+    valid = in_range & (gaps > 0) & (gaps <= MAX_PAIR_FRAMES)
+    valid &= np.cumsum(valid, axis=1) <= FAN_OUT
+
+    anchors, columns = np.nonzero(valid)
+    target_indices = targets[anchors, columns]
+    hashes = ((bins[anchors] << 16) | (bins[target_indices] << 6) | gaps[anchors, columns]).astype(np.uint32)
+    keep = _sampled(hashes)
+    return hashes[keep], frames[anchors][keep].astype(np.uint32)
+
+def _sampled(hashes):
+    """Mask of the landmarks kept by LANDMARK_SAMPLING, chosen by a multiplicative hash."""
+    mixed = (hashes.astype(np.uint64) * np.uint64(2654435761)) & np.uint64(0xFFFFFFFF)
+    return (mixed >> np.uint64(16)) < np.uint64(65536 // LANDMARK_SAMPLING)
+
+def _encode_array(values):
+    return base64.b64encode(zlib.compress(values.astype('<u4').tobytes())).decode('ascii')
+
+def _decode_array(text):
+    return np.frombuffer(zlib.decompress(base64.b64decode(text)), dtype='<u4').astype(np.uint32)
+
+class FingerprintIndex:
+    """
+    Inverted index of fingerprints held in three parallel arrays sorted by hash (hash, entry
+    position, time), persisted as one JSON document of compressed arrays.
+
+    query() aligns the query with every indexed recording at the time offset where they share
+    the most landmark hashes, then scores the recording by how much of the query's time window
+    those aligned landmarks cover. Entries are kept in insertion order, oldest first.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self._hashes = np.zeros(0, dtype=np.uint32)
+        self._positions = np.zeros(0, dtype=np.uint32)
+        self._times = np.zeros(0, dtype=np.uint32)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _append(self, entry_id, hashes, times, metadata, duration):
+        position = len(self.entries)
+        self.entries[entry_id] = {'metadata': metadata or {}, 'duration': duration}
+        self._hashes = np.concatenate([self._hashes, hashes.astype(np.uint32)])
+        self._positions = np.concatenate([self._positions, np.full(len(hashes), position, dtype=np.uint32)])
+        self._times = np.concatenate([self._times, times.astype(np.uint32)])
+
+    def _sort(self):
+        order = np.argsort(self._hashes, kind='stable')
+        self._hashes, self._positions, self._times = self._hashes[order], self._positions[order], self._times[order]
+
+    def add(self, entry_id, hashes, times, metadata=None, duration=None):
+        """Index a fingerprint under entry_id, replacing any previous one."""
+        self.remove(entry_id)
+        self._append(entry_id, hashes, times, metadata, duration)
+        self._sort()
+
+    def remove(self, entry_id):
+        if entry_id not in self.entries:
+            return
+        position = list(self.entries).index(entry_id)
+        del self.entries[entry_id]
+        keep = self._positions != position
+        self._hashes, self._positions, self._times = self._hashes[keep], self._positions[keep], self._times[keep]
+        self._positions[self._positions > position] -= 1
+
+    def trim(self, max_entries):
+        """Drop the oldest entries so at most max_entries remain."""
+        for entry_id in list(self.entries)[:max(0, len(self.entries) - max_entries)]:
+            self.remove(entry_id)
+
+    def query(self, hashes, times, min_score=0.0, exclude=None, duration=None):
+        """
+        Find the indexed recording most similar to a fingerprint.
+
+        Args:
+            hashes: Query landmark hashes
+            times: Query landmark times
+            min_score: Only return matches scoring at least this (0-1)
+            exclude: Optional entry_id to ignore (e.g. the upload being checked)
+            duration: Optional duration of the query recording in seconds. When given, only
+                recordings of a similar known duration are considered.
+
+        Returns:
+            tuple: (entry_id, score, metadata) of the best match, or None. The score is the
+            share of the query's time blocks covered by aligned landmarks.
+        """
+        if len(hashes) == 0 or len(self._hashes) == 0:
+            return None
+
+        entry_ids = list(self.entries)
+        allowed = np.array([
+            entry_id != exclude and (duration is None or durations_match(duration, entry['duration']))
+            for entry_id, entry in self.entries.items()
+        ])
+
+        # Every (query landmark, indexed landmark) pair sharing a hash
+        hashes = hashes.astype(np.uint32)
+        first = np.searchsorted(self._hashes, hashes, side='left')
+        counts = np.searchsorted(self._hashes, hashes, side='right') - first
+        total = int(counts.sum())
+        if total == 0:
+            return None
+        query_index = np.repeat(np.arange(len(hashes)), counts)
+        postings = np.repeat(first, counts) + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        positions = self._positions[postings].astype(np.int64)
+        keep = allowed[positions]
+        positions, query_index, postings = positions[keep], query_index[keep], postings[keep]
+        if len(positions) == 0:
+            return None
+        offsets = self._times[postings].astype(np.int64) - times[query_index].astype(np.int64)
+
+        # Peaks can move by one frame after re-encoding, so neighbouring offsets count together
+        keys, key_counts = np.unique((positions << 32) + offsets + (1 << 31), return_counts=True)
+        aligned = key_counts.copy()
+        for shift in (-1, 1):
+            neighbours = np.searchsorted(keys, keys + shift)
+            found = neighbours < len(keys)
+            found[found] &= keys[neighbours[found]] == keys[found] + shift
+            aligned[found] += key_counts[neighbours[found]]
+
+        # Best offset per entry: the last key of each entry after sorting by (entry, aligned count)
+        key_positions = keys >> 32
+        order = np.lexsort((aligned, key_positions))
+        last = np.r_[key_positions[order][1:] != key_positions[order][:-1], True]
+        best = order[last]
+        best = best[aligned[best] >= MIN_BLOCK_MATCHES]
+        if len(best) == 0:
+            return None
+        best_offsets = np.full(len(entry_ids), np.iinfo(np.int64).min // 2, dtype=np.int64)
+        best_offsets[key_positions[best]] = (keys[best] & 0xFFFFFFFF) - (1 << 31)
+
+        # Count aligned landmarks per time block of the query, per entry
+        matched = np.abs(offsets - best_offsets[positions]) <= 1
+        block_frames = max(1, int(COVERAGE_BLOCK_SECONDS * SAMPLE_RATE / HOP_SIZE))
+        block_count = int(times.max()) // block_frames + 1
+        blocks = times[query_index[matched]].astype(np.int64) // block_frames
+        block_matches = np.bincount(positions[matched] * block_count + blocks,
+                                    minlength=len(entry_ids) * block_count).reshape(len(entry_ids), block_count)
+        scores = np.mean(block_matches >= MIN_BLOCK_MATCHES, axis=1)
+
+        position = int(np.argmax(scores))
+        if scores[position] < min_score or scores[position] == 0:
+            return None
+        entry_id = entry_ids[position]
+        return entry_id, float(scores[position]), self.entries[entry_id]['metadata']
+
+    def to_json(self):
+        return json.dumps({
+            'entries': [
+                {'id': entry_id, 'metadata': entry['metadata'], 'duration': entry['duration']}
+                for entry_id, entry in self.entries.items()
+            ],
+            # Sorted hashes are stored as gaps, which compress far better
+            'hashes': _encode_array(np.diff(self._hashes, prepend=np.uint32(0))),
+            'positions': _encode_array(self._positions),
+            'times': _encode_array(self._times),
+        })
+
+    @classmethod
+    def from_json(cls, text):
+        index = cls()
+        document = json.loads(text)
+        if 'entries' not in document:
+            # Written before landmark sampling; its fingerprints are not comparable, start over
+            return index
+        for entry in document['entries']:
+            index.entries[entry['id']] = {'metadata': entry['metadata'], 'duration': entry['duration']}
+        index._hashes = np.cumsum(_decode_array(document['hashes']), dtype=np.uint32)
+        index._positions = _decode_array(document['positions'])
+        index._times = _decode_array(document['times'])
+        return index
@@ -18,7 +18,51 @@ class GeminiClient:
         self.model_name = model_name or os.environ.get("GEMINI_MODEL_NAME", "gemini-1.5-pro-latest")
         self.client = genai.Client(api_key=self.api_key)
 
-    def generate_content(self, prompt, response_type="text/plain", stream=True):
+    def create_cached_context(self, text, ttl_seconds=900, display_name=None):
+        """
+        Upload text once as cached context so later requests can reuse it without resending it.
+        
+        Args:
+            text: The context text to cache (e.g. a transcript)
+            ttl_seconds: How long Gemini keeps the cache alive (default: 900)
+            display_name: Optional human readable name for the cache
+            
+        Returns:
+            The cache name to pass as cached_content to generate_content
+        """
+        try:
+            cache = self.client.caches.create(
+                model=self.model_name,
+                config=types.CreateCachedContentConfig(
+                    contents=[
+                        types.Content(
+                            role="user",
+                            parts=[types.Part.from_text(text=text)],
+                        ),
+                    ],
+                    display_name=display_name,
+                    ttl=f"{int(ttl_seconds)}s",
+                ),
+            )
+            return cache.name
+        except Exception as e:
+            print(f"Error creating cached context: {str(e)}")
+            raise
+
+    def delete_cached_context(self, name):
+        """
+        Delete a cached context before its TTL expires.
+        
+        Args:
+            name: The cache name returned by create_cached_context
+        """
+        try:
+            self.client.caches.delete(name=name)
+        except Exception as e:
+            print(f"Error deleting cached context {name}: {str(e)}")
+            raise
+
+    def generate_content(self, prompt, response_type="text/plain", stream=True, cached_content=None):
         """
         Generate content using Gemini model.
         
@@ -26,6 +70,7 @@ class GeminiClient:
             prompt: The prompt text to send to Gemini
             response_type: MIME type for response (default: text/plain)
             stream: Whether to stream the response (default: True)
+            cached_content: Optional cache name from create_cached_context to use as context
             
         Returns:
             Generated content as string
@@ -39,6 +84,7 @@ class GeminiClient:
         
         generate_content_config = types.GenerateContentConfig(
             response_mime_type=response_type,
+            cached_content=cached_content,
         )
 
         try:
@@ -0,0 +1,522 @@
+"""
+Resumable multipart ingest of large recordings into the raw media bucket.
+
+Clients ask for an upload plan, hash and PUT each part straight to S3 through presigned
+URLs, in parallel, and then ask for completion. S3's own part listing is authoritative for
+which parts have arrived, so an interrupted upload resumes by sending only the missing
+parts. Each part carries a SHA-256 checksum that S3 verifies on arrival, and completion
+checks the composite checksum of all parts before the object is created. The finished
+object lands at raw-media/USER_ID/VIDEO_ID.mp4, where the bucket notification starts the
+existing lambda_function flow.
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import boto3
+import requests
+from botocore.config import Config
+
+from kv_store import open_store
+
+# S3 multipart limits
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+MAX_OBJECT_SIZE = 5 * 1024 ** 4
+# Parts are sized so a file splits into about this many, never below MIN_PART_SIZE: small
+# files get few requests and multi-GB files get parts large enough to keep throughput up
+TARGET_PART_COUNT = int(os.environ.get("INGEST_TARGET_PARTS", "500"))
+PRESIGN_EXPIRES_SECONDS = int(os.environ.get("INGEST_PRESIGN_EXPIRES_SECONDS", "3600"))
+# Upload records; s3://bucket/prefix/ in Lambda, a local directory otherwise. Must not be the
+# raw media bucket, whose notification treats every new object as media to transcribe.
+UPLOAD_STATE_LOCATION = os.environ.get("UPLOAD_STATE_LOCATION", "/tmp/upload_state")
+MIB = 1024 * 1024
+
+def choose_part_size(file_size):
+    """
+    Pick the multipart part size for a file.
+
+    Args:
+        file_size: Size of the file in bytes
+
+    Returns:
+        int: Part size in bytes, a whole number of MiB
+
+    Raises:
+        ValueError: If the file is empty or larger than S3 allows
+    """
+    if file_size <= 0:
+        raise ValueError("file_size must be positive")
+    if file_size > MAX_OBJECT_SIZE:
+        raise ValueError(f"file_size {file_size} exceeds the S3 object limit")
+
+    part_size = max(MIN_PART_SIZE, -(-file_size // TARGET_PART_COUNT))
+    part_size = -(-part_size // MIB) * MIB
+    # Only reachable with a very large TARGET_PART_COUNT
+    part_size = max(part_size, -(-file_size // MAX_PARTS))
+    return min(part_size, MAX_PART_SIZE)
+
+def part_ranges(file_size, part_size):
+    """Return (part_number, offset, length) for every part of a file."""
+    return [
+        (number, offset, min(part_size, file_size - offset))
+        for number, offset in enumerate(range(0, file_size, part_size), start=1)
+    ]
+
+def checksum_sha256(data):
+    """Base64 SHA-256 digest, the form S3 uses for x-amz-checksum-sha256."""
+    return base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+
+def composite_checksum(part_checksums):
+    """
+    Checksum S3 reports for a multipart object: the SHA-256 of the concatenated part
+    digests, suffixed with the part count.
+
+    Args:
+        part_checksums: Base64 part checksums in part order
+    """
+    digests = b''.join(base64.b64decode(checksum) for checksum in part_checksums)
+    return f"{checksum_sha256(digests)}-{len(part_checksums)}"
+
+def create_s3_client():
+    """
+    S3 client for presigning. SigV4 is required: only then is x-amz-checksum-sha256 a signed
+    header that S3 checks against the part. The default signer in some regions is SigV2, which
+    leaves the checksum as an unsigned query parameter.
+    """
+    return boto3.client('s3', config=Config(signature_version='s3v4'))
+
+def checksum_is_signed(url):
+    """Whether a presigned URL signs the x-amz-checksum-sha256 header."""
+    signed_headers = parse_qs(urlparse(url).query).get('X-Amz-SignedHeaders', [''])[0]
+    return 'x-amz-checksum-sha256' in signed_headers.split(';')
+
+def start_transcription(bucket, key):
+    """Run the transcription Lambda on an uploaded object, as the bucket notification would."""
+    # Imported here so the ingest Lambda does not load the transcription handler's dependencies
+    import lambda_function
+    
+    event = {'Records': [{'s3': {'bucket': {'name': bucket}, 'object': {'key': key}}}]}
+    return lambda_function.lambda_handler(event, None)
+
+class IngestAPI:
+    """
+    Issues, resumes and completes multipart uploads of raw media.
+
+    One record per upload is kept in the store under {upload_id}.json, and the upload in
+    progress for each video under videos/{user_id}/{video_id}.json, so a client that lost
+    its upload ID can still resume.
+    """
+
+    def __init__(self, s3, store, bucket, on_complete=None):
+        """
+        Args:
+            s3: boto3 S3 client or LocalS3
+            store: kv_store store for upload records
+            bucket: Raw media bucket
+            on_complete: Optional callable(bucket, key) run after an upload completes. Leave
+                unset in AWS, where the bucket notification already starts transcription.
+        """
+        self.s3 = s3
+        self.store = store
+        self.bucket = bucket
+        self.on_complete = on_complete
+
+    def _load(self, upload_id):
+        stored = self.store.get(f"{upload_id}.json")
+        if not stored:
+            raise ValueError(f"Unknown upload: {upload_id}")
+        return json.loads(stored)
+
+    def _save(self, record):
+        self.store.put(f"{record['upload_id']}.json", json.dumps(record))
+
+    @staticmethod
+    def _plan(record):
+        return {
+            'upload_id': record['upload_id'],
+            'bucket': record['bucket'],
+            'key': record['key'],
+            'file_size': record['file_size'],
+            'part_size': record['part_size'],
+            'part_count': record['part_count'],
+        }
+
+    def create_upload(self, user_id, video_id, file_size, content_type='video/mp4'):
+        """
+        Start a multipart upload of a video, or return the one already in progress for it.
+
+        Args:
+            user_id: The user ID
+            video_id: The video ID
+            file_size: Size of the file in bytes
+            content_type: MIME type stored with the object
+
+        Returns:
+            dict: Upload plan with upload_id, bucket, key, file_size, part_size and part_count
+
+        Raises:
+            ValueError: If an ID is invalid or the size is out of range
+        """
+        for name, value in (('user_id', user_id), ('video_id', video_id)):
+            if not value or not re.fullmatch(r'[A-Za-z0-9_-]+', value):
+                raise ValueError(f"Invalid {name}: {value!r}")
+
+        video_key = f"videos/{user_id}/{video_id}.json"
+        existing_id = self.store.get(video_key)
+        if existing_id:
+            try:
+                record = self._load(existing_id)
+            except ValueError:
+                record = None
+            if record and record['status'] == 'uploading':
+                if record['file_size'] == file_size:
+                    print(f"Resuming upload {existing_id} for {record['key']}")
+                    return self._plan(record)
+                # A different file replaces the unfinished one; free its parts
+                self.abort_upload(existing_id)
+
+        part_size = choose_part_size(file_size)
+        key = f"raw-media/{user_id}/{video_id}.mp4"
+        response = self.s3.create_multipart_upload(
+            Bucket=self.bucket,
+            Key=key,
+            ContentType=content_type,
+            ChecksumAlgorithm='SHA256'
+        )
+        record = {
+            'upload_id': response['UploadId'],
+            'bucket': self.bucket,
+            'key': key,
+            'user_id': user_id,
+            'video_id': video_id,
+            'file_size': file_size,
+            'part_size': part_size,
+            'part_count': len(part_ranges(file_size, part_size)),
+            'completed_parts': [],
+            'status': 'uploading',
+            'created_at': int(time.time()),
+        }
+        self._save(record)
+        self.store.put(video_key, record['upload_id'])
+        print(f"Created upload {record['upload_id']} for {key}: {record['part_count']} parts of {part_size} bytes")
+        return self._plan(record)
+
+    def _list_parts(self, record):
+        """Return the parts S3 has received as {part_number: part}."""
+        parts = {}
+        marker = 0
+        while True:
+            response = self.s3.list_parts(
+                Bucket=record['bucket'],
+                Key=record['key'],
+                UploadId=record['upload_id'],
+                PartNumberMarker=marker
+            )
+            for part in response.get('Parts', []):
+                parts[part['PartNumber']] = part
+            if not response.get('IsTruncated'):
+                return parts
+            marker = response['NextPartNumberMarker']
+
+    def resume_upload(self, upload_id):
+        """
+        Report which parts of an upload still have to be sent.
+
+        Returns:
+            dict: The upload plan plus completed_parts and missing_parts (part numbers)
+        """
+        record = self._load(upload_id)
+        if record['status'] != 'uploading':
+            raise ValueError(f"Upload {upload_id} is {record['status']}")
+
+        received = self._list_parts(record)
+        record['completed_parts'] = sorted(received)
+        self._save(record)
+
+        plan = self._plan(record)
+        plan['completed_parts'] = record['completed_parts']
+        plan['missing_parts'] = [n for n in range(1, record['part_count'] + 1) if n not in received]
+        return plan
+
+    def presign_parts(self, upload_id, part_checksums):
+        """
+        Issue presigned PUT URLs for parts.
+
+        Args:
+            upload_id: The upload ID
+            part_checksums: {part_number: base64 SHA-256 of the part}. The checksum is a
+                signed header, so S3 rejects a part whose bytes do not match it.
+
+        Returns:
+            dict: {part_number: url}
+
+        Raises:
+            RuntimeError: If the S3 client does not sign the checksum (see create_s3_client)
+        """
+        record = self._load(upload_id)
+        if record['status'] != 'uploading':
+            raise ValueError(f"Upload {upload_id} is {record['status']}")
+
+        urls = {}
+        for part_number, checksum in part_checksums.items():
+            part_number = int(part_number)
+            if not 1 <= part_number <= record['part_count']:
+                raise ValueError(f"Part {part_number} is outside 1-{record['part_count']}")
+            urls[part_number] = self.s3.generate_presigned_url(
+                'upload_part',
+                Params={
+                    'Bucket': record['bucket'],
+                    'Key': record['key'],
+                    'UploadId': upload_id,
+                    'PartNumber': part_number,
+                    'ChecksumSHA256': checksum,
+                },
+                ExpiresIn=PRESIGN_EXPIRES_SECONDS
+            )
+            if not checksum_is_signed(urls[part_number]):
+                raise RuntimeError("Presigned part URL does not sign the checksum; use a SigV4 S3 client")
+        return urls
+
+    def complete_upload(self, upload_id, expected_checksum=None):
+        """
+        Assemble the uploaded parts into the final object.
+
+        Args:
+            upload_id: The upload ID
+            expected_checksum: Optional composite checksum computed by the client from its
+                local file (see composite_checksum). Completion is refused if the parts S3
+                holds do not add up to it.
+
+        Returns:
+            dict: bucket, key and checksum of the completed object
+
+        Raises:
+            ValueError: If parts are missing or the checksum does not match
+        """
+        record = self._load(upload_id)
+        if record['status'] == 'completed':
+            return {'bucket': record['bucket'], 'key': record['key'], 'checksum': record['checksum']}
+        if record['status'] != 'uploading':
+            raise ValueError(f"Upload {upload_id} is {record['status']}")
+
+        received = self._list_parts(record)
+        missing = [n for n in range(1, record['part_count'] + 1) if n not in received]
+        if missing:
+            raise ValueError(f"Upload {upload_id} is missing {len(missing)} parts, first {missing[0]}")
+
+        parts = [received[n] for n in range(1, record['part_count'] + 1)]
+        checksum = composite_checksum([part['ChecksumSHA256'] for part in parts])
+        if expected_checksum and checksum != expected_checksum:
+            raise ValueError(f"Checksum mismatch for upload {upload_id}: expected {expected_checksum}, parts give {checksum}")
+
+        response = self.s3.complete_multipart_upload(
+            Bucket=record['bucket'],
+            Key=record['key'],
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [
+                {'PartNumber': part['PartNumber'], 'ETag': part['ETag'], 'ChecksumSHA256': part['ChecksumSHA256']}
+                for part in parts
+            ]}
+        )
+        reported = response.get('ChecksumSHA256')
+        if reported and reported != checksum:
+            self.s3.delete_object(Bucket=record['bucket'], Key=record['key'])
+            raise ValueError(f"S3 reported checksum {reported} for upload {upload_id}, expected {checksum}")
+
+        record['status'] = 'completed'
+        record['checksum'] = checksum
+        record['completed_parts'] = list(range(1, record['part_count'] + 1))
+        self._save(record)
+        self.store.delete(f"videos/{record['user_id']}/{record['video_id']}.json")
+        print(f"Completed upload {upload_id} to s3://{record['bucket']}/{record['key']}")
+
+        if self.on_complete:
+            self.on_complete(record['bucket'], record['key'])
+        return {'bucket': record['bucket'], 'key': record['key'], 'checksum': checksum}
+
+    def abort_upload(self, upload_id):
+        """Abandon an upload and free the parts S3 is holding for it."""
+        record = self._load(upload_id)
+        if record['status'] != 'uploading':
+            return
+        self.s3.abort_multipart_upload(Bucket=record['bucket'], Key=record['key'], UploadId=upload_id)
+        record['status'] = 'aborted'
+        self._save(record)
+        self.store.delete(f"videos/{record['user_id']}/{record['video_id']}.json")
+
+def put_presigned(url, data, checksum):
+    """PUT one part to a presigned URL and return its ETag."""
+    response = requests.put(url, data=data, headers={'x-amz-checksum-sha256': checksum}, timeout=300)
+    response.raise_for_status()
+    return response.headers.get('ETag')
+
+def upload_file(api, path, user_id, video_id, max_workers=8, send_part=put_presigned, max_attempts=3):
+    """
+    Upload a local file through the ingest API, sending parts in parallel.
+
+    Re-running after an interruption resumes the same upload and sends only the parts S3
+    has not received. A failed part is retried on its own up to max_attempts times.
+
+    Args:
+        api: IngestAPI, or any client exposing the same methods
+        path: Local media file
+        user_id: The user ID
+        video_id: The video ID
+        max_workers: Parts sent concurrently
+        send_part: Callable(url, data, checksum) performing the PUT
+        max_attempts: Attempts per part before the upload gives up
+
+    Returns:
+        dict: Result of complete_upload
+    """
+    file_size = os.path.getsize(path)
+    plan = api.create_upload(user_id, video_id, file_size)
+    status = api.resume_upload(plan['upload_id'])
+    ranges = part_ranges(file_size, plan['part_size'])
+    missing = status['missing_parts']
+    print(f"Uploading {len(missing)} of {plan['part_count']} parts of {path}")
+
+    def send(part_number):
+        _, offset, length = ranges[part_number - 1]
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        checksum = checksum_sha256(data)
+        for attempt in range(1, max_attempts + 1):
+            try:
+                # URLs are issued just before sending so they cannot expire in a long queue
+                url = api.presign_parts(plan['upload_id'], {part_number: checksum})[part_number]
+                send_part(url, data, checksum)
+                return checksum
+            except Exception as e:
+                if attempt == max_attempts:
+                    raise
+                print(f"Part {part_number} failed (attempt {attempt}): {str(e)}")
+                time.sleep(2 ** attempt)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(send, missing))
+
+    # The expected checksum covers every part, including those sent before an interruption
+    with open(path, 'rb') as f:
+        part_checksums = []
+        for _, offset, length in ranges:
+            f.seek(offset)
+            part_checksums.append(checksum_sha256(f.read(length)))
+    return api.complete_upload(plan['upload_id'], expected_checksum=composite_checksum(part_checksums))
+
+class LocalS3:
+    """
+    In-memory stand-in for the S3 multipart calls used by IngestAPI, for tests and local runs.
+
+    Presigned URLs use a local:// scheme; send them to put_presigned() on this object.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None, ChecksumAlgorithm=None):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {'bucket': Bucket, 'key': Key, 'parts': {}}
+        return {'UploadId': upload_id, 'Bucket': Bucket, 'Key': Key}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        query = {'uploadId': Params['UploadId'], 'partNumber': Params['PartNumber']}
+        if 'ChecksumSHA256' in Params:
+            query['checksum'] = Params['ChecksumSHA256']
+            query['X-Amz-SignedHeaders'] = 'host;x-amz-checksum-sha256'
+        return f"local://{Params['Bucket']}/{Params['Key']}?{urlencode(query)}"
+
+    def put_presigned(self, url, data, checksum=None):
+        query = {name: values[0] for name, values in parse_qs(urlparse(url).query).items()}
+        actual = checksum_sha256(data)
+        if query.get('checksum') and query['checksum'] != actual:
+            raise ValueError("BadDigest: part checksum does not match the signed checksum")
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self._lock:
+            upload = self._uploads[query['uploadId']]
+            upload['parts'][int(query['partNumber'])] = {'data': data, 'ETag': etag, 'ChecksumSHA256': actual}
+        return etag
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0, MaxParts=1000):
+        with self._lock:
+            parts = self._uploads[UploadId]['parts']
+            numbers = sorted(n for n in parts if n > PartNumberMarker)
+            page = numbers[:MaxParts]
+            response = {
+                'Parts': [
+                    {'PartNumber': n, 'ETag': parts[n]['ETag'], 'ChecksumSHA256': parts[n]['ChecksumSHA256'],
+                     'Size': len(parts[n]['data'])}
+                    for n in page
+                ],
+                'IsTruncated': len(numbers) > MaxParts,
+            }
+        if response['IsTruncated']:
+            response['NextPartNumberMarker'] = page[-1]
+        return response
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self._lock:
+            upload = self._uploads.pop(UploadId)
+            parts = [upload['parts'][part['PartNumber']] for part in MultipartUpload['Parts']]
+            self.objects[(Bucket, Key)] = b''.join(part['data'] for part in parts)
+        return {
+            'Bucket': Bucket,
+            'Key': Key,
+            'ChecksumSHA256': composite_checksum([part['ChecksumSHA256'] for part in parts]),
+        }
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self._lock:
+            self._uploads.pop(UploadId, None)
+
+    def delete_object(self, Bucket, Key):
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+
+def lambda_handler(event, context):
+    """
+    Entry point for the ingest Lambda. The event names an action and its arguments, e.g.
+    {"action": "create_upload", "user_id": "...", "video_id": "...", "file_size": 123}.
+
+    Actions: create_upload, resume_upload, presign_parts, complete_upload, abort_upload.
+    """
+    try:
+        api = IngestAPI(create_s3_client(), open_store(UPLOAD_STATE_LOCATION), os.environ['RAW_MEDIA_BUCKET'])
+        action = event.get('action')
+
+        if action == 'create_upload':
+            body = api.create_upload(event['user_id'], event['video_id'], int(event['file_size']),
+                                     event.get('content_type', 'video/mp4'))
+        elif action == 'resume_upload':
+            body = api.resume_upload(event['upload_id'])
+        elif action == 'presign_parts':
+            body = {'urls': api.presign_parts(event['upload_id'], event['part_checksums'])}
+        elif action == 'complete_upload':
+            body = api.complete_upload(event['upload_id'], event.get('expected_checksum'))
+        elif action == 'abort_upload':
+            api.abort_upload(event['upload_id'])
+            body = {'upload_id': event['upload_id'], 'status': 'aborted'}
+        else:
+            raise ValueError(f"Unknown action: {action}")
+
+        return {'statusCode': 200, 'body': body}
+
+    except (KeyError, ValueError) as e:
+        print(f"Invalid ingest request: {str(e)}")
+        return {'statusCode': 400, 'body': {'error': str(e)}}
+    except Exception as e:
+        print(f"Error in ingest request: {str(e)}")
+        return {'statusCode': 500, 'body': {'error': str(e)}}
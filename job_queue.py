@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+import boto3
+
+# Stages a pipeline job runs, in order. Each is checkpointed separately by the worker.
+PIPELINE_STAGES = ('chapters', 'short_summary', 'long_summary')
+
+class QueueMessage:
+    """A received job. receipt identifies this delivery for delete/release."""
+
+    def __init__(self, message_id, body, receipt):
+        self.message_id = message_id
+        self.body = body
+        self.receipt = receipt
+
+class SQSQueue:
+    """Pipeline job queue backed by Amazon SQS."""
+
+    def __init__(self, queue_url, sqs=None):
+        self.queue_url = queue_url
+        self.sqs = sqs or boto3.client('sqs')
+
+    def send(self, body):
+        response = self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(body))
+        return response['MessageId']
+
+    def receive(self, max_messages=1, wait_seconds=20):
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=max(1, min(max_messages, 10)),
+            WaitTimeSeconds=wait_seconds,
+        )
+        return [
+            QueueMessage(message['MessageId'], json.loads(message['Body']), message['ReceiptHandle'])
+            for message in response.get('Messages', [])
+        ]
+
+    def delete(self, message):
+        """Acknowledge a finished job so it is not delivered again."""
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message.receipt)
+
+    def extend(self, message, visibility_seconds):
+        """Keep a job that is still running hidden from other workers for visibility_seconds more."""
+        self.sqs.change_message_visibility(
+            QueueUrl=self.queue_url,
+            ReceiptHandle=message.receipt,
+            VisibilityTimeout=visibility_seconds,
+        )
+
+    def release(self, message):
+        """Make an unfinished job visible again immediately so another worker picks it up."""
+        self.sqs.change_message_visibility(
+            QueueUrl=self.queue_url,
+            ReceiptHandle=message.receipt,
+            VisibilityTimeout=0,
+        )
+
+class InMemoryQueue:
+    """
+    In-process queue with the same interface as SQSQueue, for tests and local runs.
+
+    Received messages stay in flight until deleted or released; released messages go back
+    to the front of the queue.
+    """
+
+    def __init__(self):
+        self._pending = deque()
+        self._in_flight = {}
+        self._condition = threading.Condition()
+
+    def send(self, body):
+        message_id = str(uuid.uuid4())
+        with self._condition:
+            self._pending.append((message_id, body))
+            self._condition.notify_all()
+        return message_id
+
+    def receive(self, max_messages=1, wait_seconds=0):
+        deadline = time.time() + wait_seconds
+        with self._condition:
+            while not self._pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                self._condition.wait(remaining)
+
+            messages = []
+            while self._pending and len(messages) < max_messages:
+                message_id, body = self._pending.popleft()
+                receipt = str(uuid.uuid4())
+                self._in_flight[receipt] = (message_id, body)
+                messages.append(QueueMessage(message_id, body, receipt))
+            return messages
+
+    def delete(self, message):
+        with self._condition:
+            self._in_flight.pop(message.receipt, None)
+
+    def extend(self, message, visibility_seconds):
+        # Messages stay in flight until deleted or released, so there is nothing to extend
+        pass
+
+    def release(self, message):
+        with self._condition:
+            entry = self._in_flight.pop(message.receipt, None)
+            if entry:
+                self._pending.appendleft(entry)
+                self._condition.notify_all()
+
+    def pending_count(self):
+        with self._condition:
+            return len(self._pending)
+
+    def in_flight_count(self):
+        with self._condition:
+            return len(self._in_flight)
+
+def open_queue(queue_url=None):
+    """Return an SQSQueue for queue_url (default: WORKER_QUEUE_URL), or None if no queue is configured."""
+    queue_url = queue_url or os.environ.get("WORKER_QUEUE_URL")
+    if not queue_url:
+        return None
+    return SQSQueue(queue_url)
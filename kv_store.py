@@ -0,0 +1,123 @@
+import fcntl
+import hashlib
+import os
+import boto3
+from botocore.exceptions import ClientError
+
+class LocalFileStore:
+    """Key/value store backed by files in a local directory. Used for tests and local runs."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def get(self, key):
+        """Return the stored text for key, or None if it does not exist."""
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, value):
+        """Store text under key, replacing any previous value."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial value
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _version(value):
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+    def get_versioned(self, key):
+        """Return (text, version) for key, or (None, None) if it does not exist."""
+        value = self.get(key)
+        return (value, self._version(value)) if value is not None else (None, None)
+
+    def put_if_version(self, key, value, version):
+        """
+        Store text under key only if the stored version is still version (None: key must not
+        exist). Returns False without writing if another writer got there first.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.get_versioned(key)[1] != version:
+                return False
+            self.put(key, value)
+            return True
+
+class S3Store:
+    """Key/value store backed by objects under a prefix in an S3 bucket."""
+
+    def __init__(self, bucket, prefix='', s3=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = s3 or boto3.client('s3')
+
+    def get(self, key):
+        """Return the stored text for key, or None if it does not exist."""
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read().decode('utf-8')
+
+    def put(self, key, value):
+        """Store text under key, replacing any previous value."""
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=value.encode('utf-8'))
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def get_versioned(self, key):
+        """Return (text, version) for key, or (None, None) if it does not exist. The version is the ETag."""
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except self.s3.exceptions.NoSuchKey:
+            return None, None
+        return response['Body'].read().decode('utf-8'), response['ETag']
+
+    def put_if_version(self, key, value, version):
+        """
+        Store text under key only if its ETag is still version (None: key must not exist), using
+        S3 conditional writes. Returns False without writing if another writer got there first.
+        """
+        condition = {'IfMatch': version} if version is not None else {'IfNoneMatch': '*'}
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=value.encode('utf-8'), **condition)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
+def open_store(location):
+    """
+    Create a store from a location string.
+
+    Args:
+        location: s3://bucket/prefix/ for S3, anything else is treated as a local directory
+
+    Returns:
+        LocalFileStore or S3Store
+    """
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return S3Store(bucket, prefix)
+    return LocalFileStore(location)
@@ -3,6 +3,128 @@ import os
 from urllib.parse import urlparse, quote, unquote_plus
 import time
 import re
+from fingerprint import FingerprintIndex, compute_fingerprint, decode_audio, media_duration
+from kv_store import open_store
+from supabase_client import get_document, update_document
+
+# Per-user fingerprint indexes; s3://bucket/prefix/ in Lambda, a local directory otherwise
+FINGERPRINT_INDEX_LOCATION = os.environ.get("FINGERPRINT_INDEX_LOCATION", "/tmp/fingerprint_index")
+# Only the start of the recording is fingerprinted, which is enough to recognise a re-upload
+FINGERPRINT_SECONDS = int(os.environ.get("FINGERPRINT_SECONDS", "180"))
+# Share of the fingerprinted window that must line up with an earlier upload for it to count as
+# the same recording. Re-encoded and trimmed copies cover 0.5 or more; different recordings
+# sharing an intro or outro cover about the intro's share of the window.
+FINGERPRINT_MATCH_THRESHOLD = float(os.environ.get("FINGERPRINT_MATCH_THRESHOLD", "0.3"))
+# Each user's index keeps the fingerprints of this many most recent uploads (about 18 KB each)
+FINGERPRINT_INDEX_MAX_ENTRIES = int(os.environ.get("FINGERPRINT_INDEX_MAX_ENTRIES", "200"))
+# Concurrent uploads of one user update the same index; a writer that loses the race re-reads it
+FINGERPRINT_INDEX_WRITE_ATTEMPTS = 5
+# Near-silent media yields too few landmarks to compare reliably
+FINGERPRINT_MIN_HASHES = 200
+
+def fingerprint_media(s3, bucket, key):
+    """
+    Decode the start of an uploaded media file straight from S3 and fingerprint it.
+    
+    Returns:
+        tuple: (hashes, times, duration); duration is None if ffmpeg could not read it
+    """
+    media_url = s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=900)
+    duration = media_duration(media_url)
+    samples = decode_audio(media_url, max_seconds=FINGERPRINT_SECONDS)
+    hashes, times = compute_fingerprint(samples)
+    return hashes, times, duration
+
+def copy_processed_video(s3, output_bucket, user_id, source, video_id):
+    """
+    Copy the transcript, chapters and summaries of an already processed upload to a new video.
+    
+    Args:
+        s3: boto3 S3 client
+        output_bucket: The processed transcripts bucket
+        user_id: The user ID
+        source: Index metadata of the earlier upload (video_id, transcript_key)
+        video_id: The new video ID
+        
+    Returns:
+        bool: True if the results were copied, False if the earlier upload has not finished
+        processing or any of its files could not be copied
+    """
+    source_video_id = source['video_id']
+    document = get_document(user_id, source_video_id)
+    if not document or document.get('processing_status') != 'completed':
+        print(f"Matched video {source_video_id} has not finished processing, transcribing instead")
+        return False
+    
+    # The transcript copy is kept outside transcripts/ so it does not trigger the chapter generator
+    copies = [
+        (source['transcript_key'], f"deduplicated/{user_id}/{video_id}_transcript.json"),
+        (f"chapters/{user_id}/{source_video_id}_chapters.txt", f"chapters/{user_id}/{video_id}_chapters.txt"),
+        (f"plain_text/{user_id}/{source_video_id}_transcript.txt", f"plain_text/{user_id}/{video_id}_transcript.txt"),
+    ]
+    for source_key, target_key in copies:
+        try:
+            s3.copy_object(Bucket=output_bucket, Key=target_key,
+                           CopySource={'Bucket': output_bucket, 'Key': source_key})
+        except Exception as e:
+            # Marking the video completed now would leave it without these files, so transcribe it
+            print(f"Could not copy s3://{output_bucket}/{source_key}, transcribing instead: {str(e)}")
+            return False
+    
+    update_document(user_id, video_id, {
+        "transcription": document.get("transcription"),
+        "chapters": document.get("chapters"),
+        "short_summary": document.get("short_summary"),
+        "long_summary": document.get("long_summary"),
+        "processing_status": "completed"
+    })
+    return True
+
+def deduplicate_upload(s3, bucket, key, user_id, video_id, job_name):
+    """
+    Check whether an upload is another copy of a recording the user already processed.
+    
+    On a match the earlier results are copied to video_id. Otherwise the upload's fingerprint
+    is added to the user's index so later re-uploads can match it. Any failure (e.g. ffmpeg
+    unavailable) is logged and the upload is transcribed as usual.
+    
+    Returns:
+        str: The video ID the results were copied from, or None if the upload must be transcribed
+    """
+    try:
+        hashes, times, duration = fingerprint_media(s3, bucket, key)
+        if len(hashes) < FINGERPRINT_MIN_HASHES:
+            print(f"Only {len(hashes)} fingerprint landmarks, skipping deduplication")
+            return None
+        if duration is None:
+            print("Could not read the media duration, skipping deduplication")
+            return None
+        
+        store = open_store(FINGERPRINT_INDEX_LOCATION)
+        index_key = f"{user_id}.json"
+        for attempt in range(FINGERPRINT_INDEX_WRITE_ATTEMPTS):
+            stored_index, version = store.get_versioned(index_key)
+            index = FingerprintIndex.from_json(stored_index) if stored_index else FingerprintIndex()
+            
+            match = index.query(hashes, times, min_score=FINGERPRINT_MATCH_THRESHOLD, exclude=video_id, duration=duration)
+            if match:
+                source_video_id, score, source = match
+                print(f"Upload matches video {source_video_id} (score {score:.3f})")
+                if copy_processed_video(s3, os.environ['OUTPUT_BUCKET'], user_id, source, video_id):
+                    return source_video_id
+            
+            index.add(video_id, hashes, times, {'video_id': video_id, 'transcript_key': f"transcripts/{job_name}.json"}, duration)
+            index.trim(FINGERPRINT_INDEX_MAX_ENTRIES)
+            if store.put_if_version(index_key, index.to_json(), version):
+                return None
+            print(f"Fingerprint index changed during update (attempt {attempt + 1}), retrying")
+        
+        print("Could not update the fingerprint index, transcribing without indexing")
+        return None
+        
+    except Exception as e:
+        print(f"Fingerprint deduplication skipped: {str(e)}")
+        return None
 
 def lambda_handler(event, context):
     try:
@@ -83,6 +205,19 @@ def lambda_handler(event, context):
         else:
             raise ValueError(f'Unsupported file format: {file_extension}')
         
+        # Reuse the results of an earlier upload of the same recording instead of transcribing again
+        if user_id and video_id:
+            source_video_id = deduplicate_upload(s3, bucket, decoded_key, clean_user_id, clean_video_id, job_name)
+            if source_video_id:
+                return {
+                    'statusCode': 200,
+                    'body': {
+                        'jobName': None,
+                        'status': 'deduplicated',
+                        'sourceVideoId': source_video_id
+                    }
+                }
+        
         print(f'Starting transcription job: {job_name} for file: {decoded_key}')
         
         # Construct the S3 URI for the transcription job
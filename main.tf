@@ -4,18 +4,12 @@ provider "aws" {
   profile = var.aws_profile
 }
 
-# Add this at the beginning of the file, after the provider block
-data "archive_file" "lambda_zip" {
-  type        = "zip"
-  source_file = "${path.module}/lambda_function.py"
-  output_path = "${path.module}/lambda_function.zip"
-}
-
 # Create a ZIP file for chapter generator lambda with dependencies
 resource "null_resource" "install_dependencies" {
   triggers = {
     dependencies_versions = filemd5("${path.module}/requirements.txt")
     source_code = filemd5("${path.module}/chapter_generator.py")
+    transcription_source = filemd5("${path.module}/lambda_function.py")
     force_rebuild = timestamp()
   }
 
@@ -160,19 +154,27 @@ resource "aws_iam_role_policy" "transcription_lambda_policy" {
 }
 
 # Lambda Function
+# Shares the dependency package with the chapter generator: fingerprinting needs numpy and
+# deduplicated uploads are written to Supabase
 resource "aws_lambda_function" "transcription_processor" {
-  filename         = data.archive_file.lambda_zip.output_path
+  filename         = data.archive_file.chapter_generator_zip.output_path
   function_name    = "${var.project_prefix}-processor"
   role            = aws_iam_role.transcription_lambda_role.arn
   handler         = "lambda_function.lambda_handler"
   runtime         = "python3.9"
   timeout         = 300
-  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
+  memory_size     = 1024
+  source_code_hash = data.archive_file.chapter_generator_zip.output_base64sha256
+  layers          = var.ffmpeg_layer_arn != "" ? [var.ffmpeg_layer_arn] : []
 
   environment {
     variables = {
       OUTPUT_BUCKET = aws_s3_bucket.processed_transcripts_output.id
       REGION        = var.aws_region
+      SUPABASE_URL = var.supabase_url
+      SUPABASE_SERVICE_KEY = var.supabase_service_key
+      FFMPEG_PATH = "/opt/bin/ffmpeg"
+      FINGERPRINT_INDEX_LOCATION = "s3://${aws_s3_bucket.processed_transcripts_output.id}/fingerprint_index/"
     }
   }
 }
@@ -265,10 +267,49 @@ resource "aws_lambda_function" "chapter_generator" {
       REGION = var.aws_region
       SUPABASE_URL = var.supabase_url
       SUPABASE_SERVICE_KEY = var.supabase_service_key
+      # Heavy transcripts are only routed to the queue when the worker service consuming it exists
+      WORKER_QUEUE_URL = var.pipeline_worker_image != "" ? aws_sqs_queue.pipeline_jobs.url : ""
+      STAGE_STATE_LOCATION = "s3://${aws_s3_bucket.processed_transcripts_output.id}/pipeline_state/"
     }
   }
 }
 
+# Queue of heavy transcripts routed from the chapter generator to the ECS pipeline worker
+resource "aws_sqs_queue" "pipeline_jobs_dlq" {
+  name                      = "${var.project_prefix}-pipeline-jobs-dlq"
+  message_retention_seconds = 1209600
+}
+
+resource "aws_sqs_queue" "pipeline_jobs" {
+  name                       = "${var.project_prefix}-pipeline-jobs"
+  visibility_timeout_seconds = 1800
+  receive_wait_time_seconds  = 20
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.pipeline_jobs_dlq.arn
+    maxReceiveCount     = 5
+  })
+}
+
+# Allow the Chapter Generator Lambda to route jobs to the pipeline worker
+resource "aws_iam_role_policy" "chapter_generator_sqs_policy" {
+  name = "${var.project_prefix}-chapter-generator-sqs-policy"
+  role = aws_iam_role.chapter_generator_lambda_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "sqs:SendMessage"
+        ]
+        Resource = [aws_sqs_queue.pipeline_jobs.arn]
+      }
+    ]
+  })
+}
+
 # S3 Event Trigger for Chapter Generator Lambda
 resource "aws_s3_bucket_notification" "transcript_notification" {
   bucket = aws_s3_bucket.processed_transcripts_output.id
@@ -322,7 +363,8 @@ resource "aws_iam_role_policy" "summary_generator_lambda_policy" {
         Effect = "Allow"
         Action = [
           "s3:GetObject",
-          "s3:ListBucket"
+          "s3:ListBucket",
+          "s3:PutObject"
         ]
         Resource = [
           aws_s3_bucket.processed_transcripts_output.arn,
@@ -359,6 +401,8 @@ resource "aws_lambda_function" "summary_generator" {
       GEMINI_MODEL_NAME = var.gemini_model_name
       SUPABASE_URL = var.supabase_url
       SUPABASE_SERVICE_KEY = var.supabase_service_key
+      SUMMARY_CACHE_LOCATION = "s3://${aws_s3_bucket.processed_transcripts_output.id}/summary_cache/"
+      STAGE_STATE_LOCATION = "s3://${aws_s3_bucket.processed_transcripts_output.id}/pipeline_state/"
     }
   }
 }
@@ -455,6 +499,115 @@ resource "aws_lambda_permission" "allow_eventbridge" {
   source_arn    = "arn:aws:events:${var.aws_region}:${data.aws_caller_identity.current.account_id}:rule/*"
 }
 
+# Abandoned multipart uploads keep their parts (and storage cost) until aborted
+resource "aws_s3_bucket_lifecycle_configuration" "raw_media_input" {
+  bucket = aws_s3_bucket.raw_media_input.id
+
+  rule {
+    id     = "abort-incomplete-multipart-uploads"
+    status = "Enabled"
+
+    filter {
+      prefix = "raw-media/"
+    }
+
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 7
+    }
+  }
+}
+
+# IAM Role for the Ingest API Lambda
+resource "aws_iam_role" "ingest_api_lambda_role" {
+  name = "${var.project_prefix}-ingest-api-role"
+
+  assume_role_policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action = "sts:AssumeRole"
+        Effect = "Allow"
+        Principal = {
+          Service = "lambda.amazonaws.com"
+        }
+      }
+    ]
+  })
+}
+
+# IAM Policy for the Ingest API Lambda. Presigned part URLs carry the role's permissions.
+resource "aws_iam_role_policy" "ingest_api_lambda_policy" {
+  name = "${var.project_prefix}-ingest-api-policy"
+  role = aws_iam_role.ingest_api_lambda_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:PutObject",
+          "s3:AbortMultipartUpload",
+          "s3:ListMultipartUploadParts",
+          "s3:DeleteObject"
+        ]
+        Resource = [
+          "${aws_s3_bucket.raw_media_input.arn}/raw-media/*"
+        ]
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject",
+          "s3:PutObject",
+          "s3:DeleteObject"
+        ]
+        Resource = [
+          "${aws_s3_bucket.processed_transcripts_output.arn}/ingest_uploads/*"
+        ]
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:ListBucket"
+        ]
+        Resource = [
+          aws_s3_bucket.processed_transcripts_output.arn
+        ]
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "logs:CreateLogGroup",
+          "logs:CreateLogStream",
+          "logs:PutLogEvents"
+        ]
+        Resource = ["arn:aws:logs:*:*:*"]
+      }
+    ]
+  })
+}
+
+# Ingest API Lambda Function: issues, resumes and completes multipart uploads of raw media.
+# Completed uploads start transcription through the raw media bucket notification.
+resource "aws_lambda_function" "ingest_api" {
+  filename         = data.archive_file.chapter_generator_zip.output_path
+  function_name    = "${var.project_prefix}-ingest-api"
+  role             = aws_iam_role.ingest_api_lambda_role.arn
+  handler          = "ingest_api.lambda_handler"
+  runtime          = "python3.9"
+  timeout          = 60
+  memory_size      = 256
+  source_code_hash = data.archive_file.chapter_generator_zip.output_base64sha256
+
+  environment {
+    variables = {
+      RAW_MEDIA_BUCKET = aws_s3_bucket.raw_media_input.id
+      UPLOAD_STATE_LOCATION = "s3://${aws_s3_bucket.processed_transcripts_output.id}/ingest_uploads/"
+    }
+  }
+}
+
 # Get current AWS account ID
 data "aws_caller_identity" "current" {}
 
@@ -485,6 +638,13 @@ module "ecs_worker" {
   task_memory    = 4096    # 4GB RAM
   desired_count  = 1       # Number of tasks to run
 
+  # Pipeline worker consuming heavy transcripts
+  pipeline_queue_url     = aws_sqs_queue.pipeline_jobs.url
+  pipeline_queue_arn     = aws_sqs_queue.pipeline_jobs.arn
+  pipeline_worker_image  = var.pipeline_worker_image
+  gemini_api_key         = var.gemini_api_key
+  gemini_model_name      = var.gemini_model_name
+
   # New variables
   aws_access_key_id     = var.aws_access_key_id
   aws_secret_access_key = var.aws_secret_access_key
@@ -202,6 +202,26 @@ resource "aws_iam_role_policy" "ecs_task" {
           "arn:aws:s3:::${var.processed_transcripts_bucket}",
           "arn:aws:s3:::${var.processed_transcripts_bucket}/*"
         ]
+      },
+      {
+        # The pipeline worker removes a job's checkpoint once every stage has finished
+        Effect = "Allow"
+        Action = [
+          "s3:DeleteObject"
+        ]
+        Resource = [
+          "arn:aws:s3:::${var.processed_transcripts_bucket}/worker_checkpoints/*"
+        ]
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "sqs:ReceiveMessage",
+          "sqs:DeleteMessage",
+          "sqs:ChangeMessageVisibility",
+          "sqs:GetQueueAttributes"
+        ]
+        Resource = [var.pipeline_queue_arn]
       }
     ]
   })
@@ -285,4 +305,76 @@ resource "aws_ecs_service" "worker" {
     capacity_provider = "FARGATE_SPOT"
     weight           = 100
   }
-} 
\ No newline at end of file
+} 
+
+# Pipeline Worker Task Definition (runs worker.py for transcripts routed from the chapter generator)
+resource "aws_ecs_task_definition" "pipeline_worker" {
+  count                    = var.pipeline_worker_image == "" ? 0 : 1
+  family                   = "${var.project_prefix}-pipeline-worker"
+  requires_compatibilities = ["FARGATE"]
+  network_mode            = "awsvpc"
+  cpu                     = var.task_cpu
+  memory                  = var.task_memory
+  execution_role_arn      = aws_iam_role.ecs_task_execution.arn
+  task_role_arn          = aws_iam_role.ecs_task.arn
+
+  container_definitions = jsonencode([
+    {
+      name      = "pipeline-worker"
+      image     = var.pipeline_worker_image
+      essential = true
+      command   = ["python", "worker.py"]
+
+      # Fargate Spot sends SIGTERM two minutes before reclaiming the task; give the worker
+      # the full window to finish running stages and release its jobs
+      stopTimeout = 120
+
+      environment = [
+        { name = "AWS_REGION", value = var.aws_region },
+        { name = "WORKER_QUEUE_URL", value = var.pipeline_queue_url },
+        { name = "WORKER_CHECKPOINT_LOCATION", value = "s3://${var.processed_transcripts_bucket}/worker_checkpoints/" },
+        { name = "SUMMARY_CACHE_LOCATION", value = "s3://${var.processed_transcripts_bucket}/summary_cache/" },
+        { name = "GEMINI_API_KEY", value = var.gemini_api_key },
+        { name = "GEMINI_MODEL_NAME", value = var.gemini_model_name },
+        { name = "SUPABASE_URL", value = var.supabase_url }
+      ]
+
+      secrets = [
+        {
+          name      = "SUPABASE_SERVICE_KEY"
+          valueFrom = var.supabase_service_key_arn
+        }
+      ]
+
+      logConfiguration = {
+        logDriver = "awslogs"
+        options = {
+          "awslogs-group"         = aws_cloudwatch_log_group.ecs.name
+          "awslogs-region"        = var.aws_region
+          "awslogs-stream-prefix" = "pipeline-worker"
+        }
+      }
+    }
+  ])
+}
+
+# Pipeline Worker Service
+resource "aws_ecs_service" "pipeline_worker" {
+  count            = var.pipeline_worker_image == "" ? 0 : 1
+  name             = "${var.project_prefix}-pipeline-worker"
+  cluster          = aws_ecs_cluster.main.id
+  task_definition  = aws_ecs_task_definition.pipeline_worker[0].arn
+  desired_count    = var.pipeline_worker_count
+  platform_version = "LATEST"
+
+  network_configuration {
+    subnets          = aws_subnet.public[*].id
+    security_groups  = [aws_security_group.ecs_tasks.id]
+    assign_public_ip = true
+  }
+
+  capacity_provider_strategy {
+    capacity_provider = "FARGATE_SPOT"
+    weight           = 100
+  }
+}
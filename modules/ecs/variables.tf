@@ -118,4 +118,37 @@ variable "proxy_password" {
   description = "Proxy authentication password"
   type        = string
   default     = ""
-} 
\ No newline at end of file
+} 
+
+variable "pipeline_worker_image" {
+  description = "Container image (with tag) running worker.py; leave empty to skip the pipeline worker service"
+  type        = string
+  default     = ""
+}
+
+variable "pipeline_worker_count" {
+  description = "Desired number of pipeline worker tasks"
+  type        = number
+  default     = 1
+}
+
+variable "pipeline_queue_url" {
+  description = "URL of the SQS queue the pipeline worker consumes"
+  type        = string
+}
+
+variable "pipeline_queue_arn" {
+  description = "ARN of the SQS queue the pipeline worker consumes"
+  type        = string
+}
+
+variable "gemini_api_key" {
+  description = "Google Gemini API key for the pipeline worker"
+  type        = string
+  sensitive   = true
+}
+
+variable "gemini_model_name" {
+  description = "Google Gemini model name for the pipeline worker"
+  type        = string
+}
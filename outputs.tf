@@ -16,4 +16,14 @@ output "processed_transcripts_bucket_name" {
 output "lambda_function_name" {
   description = "Name of the Lambda function"
   value       = aws_lambda_function.transcription_processor.function_name
-} 
\ No newline at end of file
+} 
+
+output "pipeline_jobs_queue_url" {
+  description = "URL of the SQS queue consumed by the pipeline worker"
+  value       = aws_sqs_queue.pipeline_jobs.url
+}
+
+output "ingest_api_function_name" {
+  description = "Name of the Lambda function issuing resumable multipart uploads"
+  value       = aws_lambda_function.ingest_api.function_name
+}
\ No newline at end of file
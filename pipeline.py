@@ -0,0 +1,158 @@
+"""
+Stage functions shared by the batch reprocessing CLI and the queue worker.
+
+Each stage takes an explicit storage backend and Gemini client so callers can reuse
+warm clients across many videos, and raises instead of storing placeholder text when
+Gemini fails, so the caller can retry the video later.
+"""
+import os
+
+import boto3
+
+from chapter_generator import (
+    FALLBACK_CHAPTERS,
+    estimate_video_duration_minutes,
+    extract_plain_transcript,
+    format_transcript_with_detailed_timestamps,
+    generate_chapters_with_gemini,
+)
+from summary_generator import summarize_transcript, summary_error_message
+from supabase_client import update_chapters, update_document, update_summary, update_transcript
+
+TRANSCRIPTS_PREFIX = 'transcripts/'
+
+class LocalStorage:
+    """Read and write pipeline objects in a local directory laid out like the output bucket."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def list_keys(self, prefix):
+        keys = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def read_text(self, key):
+        with open(os.path.join(self.root, key), 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def write_text(self, key, body):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(body)
+
+    def describe(self, key):
+        return os.path.join(self.root, key)
+
+class S3Storage:
+    """Read and write pipeline objects in an S3 bucket."""
+
+    def __init__(self, bucket, s3=None):
+        self.bucket = bucket
+        self.s3 = s3 or boto3.client('s3')
+
+    def list_keys(self, prefix):
+        keys = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                keys.append(obj['Key'])
+        return sorted(keys)
+
+    def read_text(self, key):
+        response = self.s3.get_object(Bucket=self.bucket, Key=key)
+        return response['Body'].read().decode('utf-8')
+
+    def write_text(self, key, body):
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType='text/plain')
+
+    def describe(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+def prepare_transcript(transcript_json):
+    """
+    Derive the texts used by both stages from the raw transcript JSON.
+
+    Returns:
+        tuple: (full_transcript_text, detailed_transcript_text, video_duration_minutes)
+    """
+    full_transcript_text = transcript_json['results']['transcripts'][0]['transcript']
+    items = transcript_json['results']['items']
+
+    video_duration_minutes = estimate_video_duration_minutes(items)
+    detailed_transcript_text = format_transcript_with_detailed_timestamps(items, interval_seconds=10)
+    if not detailed_transcript_text:
+        detailed_transcript_text = full_transcript_text
+    return full_transcript_text, detailed_transcript_text, video_duration_minutes
+
+def run_chapters_stage(storage, transcript_json, user_id, video_id, gemini=None, cached_content=None,
+                       update_db=True, update_status=True):
+    """
+    Generate chapters and the plain transcript for one video and store them.
+
+    Args:
+        storage: LocalStorage or S3Storage the outputs are written to
+        transcript_json: The parsed Transcribe output
+        user_id: The user ID
+        video_id: The video ID
+        gemini: Optional GeminiClient to reuse
+        cached_content: Optional Gemini cache name holding the transcript
+        update_db: Whether to write the results to Supabase
+        update_status: Whether to move processing_status to processing_summaries
+
+    Returns:
+        str: The generated chapters
+
+    Raises:
+        RuntimeError: If Gemini could not generate chapters
+    """
+    _, detailed_transcript_text, video_duration_minutes = prepare_transcript(transcript_json)
+
+    chapters = generate_chapters_with_gemini(detailed_transcript_text, video_duration_minutes,
+                                             gemini=gemini, cached_content=cached_content)
+    if chapters == FALLBACK_CHAPTERS:
+        raise RuntimeError("Chapter generation failed")
+
+    plain_transcript = extract_plain_transcript(transcript_json)
+    storage.write_text(f"chapters/{user_id}/{video_id}_chapters.txt", chapters)
+    storage.write_text(f"plain_text/{user_id}/{video_id}_transcript.txt", plain_transcript)
+
+    if update_db:
+        update_transcript(user_id, video_id, plain_transcript)
+        if update_status:
+            update_chapters(user_id, video_id, chapters)
+        else:
+            # Summaries are not being regenerated, so leave processing_status untouched
+            update_document(user_id, video_id, {"chapters": chapters})
+
+    return chapters
+
+def run_summary_stage(transcript_json, user_id, video_id, summary_type, gemini=None, cached_content=None,
+                      store=None, update_db=True):
+    """
+    Generate one summary for a video and store it.
+
+    Returns:
+        str: The generated summary
+
+    Raises:
+        RuntimeError: If Gemini could not generate the summary
+    """
+    full_transcript_text = transcript_json['results']['transcripts'][0]['transcript']
+    items = transcript_json['results']['items']
+
+    summary = summarize_transcript(full_transcript_text, summary_type, gemini=gemini,
+                                   cached_content=cached_content, items=items, store=store)
+    if summary == summary_error_message(summary_type):
+        raise RuntimeError(f"{summary_type} summary generation failed")
+
+    if update_db:
+        update_summary(user_id, video_id, summary, summary_type)
+
+    return summary
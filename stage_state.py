@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+from kv_store import open_store
+
+# s3://bucket/prefix/ in Lambda; a local directory for tests and local runs
+STAGE_STATE_LOCATION = os.environ.get("STAGE_STATE_LOCATION", "/tmp/stage_state")
+
+def hash_text(text):
+    """Return the SHA-256 hex digest of text."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def get_stage_state_store():
+    """Return the store holding stage state records."""
+    return open_store(STAGE_STATE_LOCATION)
+
+class StageState:
+    """
+    Per-video record of the pipeline stages that have completed.
+
+    Handlers check it on entry and skip finished steps, so a retry after a late failure
+    (e.g. a Supabase error) only repeats the step that failed instead of the Gemini work.
+
+    The transcript binding, chapters, cached context and summary mode live in one record
+    written only by the chapter generator. Each completed step is stored under its own key, so the short and
+    long summary Lambdas running at the same time never overwrite each other's progress.
+    A step key holds the transcript hash it was completed for, so steps from an earlier
+    transcript of the video no longer count once the video is re-transcribed.
+    """
+
+    STEP_KINDS = ('s3_writes', 'db_writes', 'events')
+
+    def __init__(self, store, user_id, video_id):
+        self.store = store
+        self.prefix = f"{user_id}/{video_id}"
+        self.key = f"{self.prefix}.json"
+        stored = store.get(self.key)
+        self.record = json.loads(stored) if stored else self._empty_record()
+
+    @staticmethod
+    def _empty_record():
+        return {
+            'transcript_key': None,
+            'transcript_etag': None,
+            'transcript_hash': None,
+            'chapters': None,
+            'cached_content': None,
+            'hierarchical_summaries': None,
+        }
+
+    def save(self):
+        self.store.put(self.key, json.dumps(self.record))
+
+    def matches_source(self, transcript_key, transcript_etag):
+        """Whether the record was built from this exact transcript object."""
+        return (transcript_etag is not None
+                and self.record['transcript_key'] == transcript_key
+                and self.record['transcript_etag'] == transcript_etag)
+
+    def start_transcript(self, transcript_key, transcript_etag, transcript_hash):
+        """
+        Bind the record to a transcript. If the video was re-transcribed with different
+        content, the previous progress no longer applies and the record starts over.
+        """
+        if self.record['transcript_hash'] != transcript_hash:
+            self.record = self._empty_record()
+        self.record['transcript_key'] = transcript_key
+        self.record['transcript_etag'] = transcript_etag
+        self.record['transcript_hash'] = transcript_hash
+        self.save()
+
+    def get(self, field):
+        return self.record.get(field)
+
+    def set(self, field, value):
+        self.record[field] = value
+        self.save()
+
+    def _step_key(self, kind, name):
+        if kind not in self.STEP_KINDS:
+            raise ValueError(f"Unknown step kind: {kind}")
+        return f"{self.prefix}/{kind}/{name}"
+
+    def is_done(self, kind, name):
+        """Check a step of kind 's3_writes', 'db_writes' or 'events' for the current transcript."""
+        return self.store.get(self._step_key(kind, name)) == (self.record['transcript_hash'] or '')
+
+    def mark_done(self, kind, name):
+        self.store.put(self._step_key(kind, name), self.record['transcript_hash'] or '')
@@ -1,34 +1,305 @@
 import json
 import os
+import re
+import zlib
+import hashlib
+import boto3
+from concurrent.futures import ThreadPoolExecutor
 from gemini_client import GeminiClient
+from kv_store import open_store
+from stage_state import StageState, get_stage_state_store
 from supabase_client import update_summary
 
-def generate_summary(transcript_text, summary_type):
-    """Generate either a short or long summary using Gemini."""
-    try:
-        gemini = GeminiClient()
-        
-        if summary_type == 'short':
-            prompt = f"""Generate a very concise 1-2 sentence summary of the following transcript that captures its main point or key takeaway. Keep it under 50 words.
+# 'single' sends the whole transcript in one prompt, 'hierarchical' summarises sections first,
+# 'auto' switches to hierarchical for long transcripts or when the single prompt fails
+SUMMARY_MODE = os.environ.get("SUMMARY_MODE", "auto")
+HIERARCHICAL_SUMMARY_MIN_CHARS = int(os.environ.get("HIERARCHICAL_SUMMARY_MIN_CHARS", "120000"))
+SUMMARY_SECTION_SECONDS = int(os.environ.get("SUMMARY_SECTION_SECONDS", "600"))
+SUMMARY_SECTION_WORKERS = int(os.environ.get("SUMMARY_SECTION_WORKERS", "4"))
+# Section, reduced and short summaries are memoised here, keyed by a hash of their input
+SUMMARY_CACHE_LOCATION = os.environ.get("SUMMARY_CACHE_LOCATION", "/tmp/summary_cache")
+# Bump when the hierarchical prompts change so memoised summaries are regenerated
+SUMMARY_PROMPT_VERSION = "1"
+
+def summary_error_message(summary_type):
+    """Placeholder text stored when a summary could not be generated."""
+    return f"Error generating {summary_type} summary."
+
+def build_summary_prompt(summary_type, transcript_text=None):
+    """
+    Build the prompt for a short or long summary.
+    
+    Args:
+        summary_type: Either 'short' or 'long'
+        transcript_text: The transcript to include. If omitted, the prompt refers to a
+            transcript already supplied as cached context.
+    """
+    if transcript_text is None:
+        subject = "the transcript provided in the context above (ignore the [MM:SS] timestamps)"
+        transcript_section = ""
+    else:
+        subject = "the following transcript"
+        transcript_section = f"""
 
 Transcript:
 {transcript_text}"""
-        else:  # long summary
-            prompt = f"""Generate a detailed summary of the following transcript. The summary should:
+    
+    if summary_type == 'short':
+        return f"""Generate a very concise 1-2 sentence summary of {subject} that captures its main point or key takeaway. Keep it under 50 words.{transcript_section}"""
+    
+    # long summary
+    return f"""Generate a detailed summary of {subject}. The summary should:
+1. Be around 4-6 paragraphs
+2. Capture all major points and key details
+3. Maintain the logical flow of ideas
+4. Be written in clear, professional language
+5. Be comprehensive enough for someone to understand the full content without watching the video{transcript_section}"""
+
+def generate_summary(transcript_text, summary_type, gemini=None, cached_content=None):
+    """
+    Generate either a short or long summary using Gemini.
+    
+    If cached_content names a Gemini cache holding the transcript, only the instructions
+    are sent. Should the cache have expired, the transcript is sent inline instead.
+    """
+    try:
+        gemini = gemini or GeminiClient()
+        
+        if cached_content:
+            try:
+                return gemini.generate_content(build_summary_prompt(summary_type), cached_content=cached_content)
+            except Exception as e:
+                print(f"Cached context unavailable, sending transcript inline: {str(e)}")
+        
+        return gemini.generate_content(build_summary_prompt(summary_type, transcript_text))
+        
+    except Exception as e:
+        print(f"Error generating {summary_type} summary: {str(e)}")
+        return summary_error_message(summary_type)
+
+def use_hierarchical_summary(transcript_text):
+    """Decide up front whether a transcript should be summarised section by section."""
+    if SUMMARY_MODE == 'hierarchical':
+        return True
+    return SUMMARY_MODE == 'auto' and len(transcript_text) > HIERARCHICAL_SUMMARY_MIN_CHARS
+
+def _join_items(items):
+    words = []
+    for item in items:
+        content = item['alternatives'][0]['content']
+        if item.get('type') == 'punctuation' and words:
+            words[-1] += content
+        else:
+            words.append(content)
+    return ' '.join(words)
+
+def split_transcript_sections(items, section_seconds=SUMMARY_SECTION_SECONDS):
+    """
+    Split transcript items into fixed time windows.
+    
+    Boundaries sit on a fixed grid (0-10 min, 10-20 min, ...), so editing words in one
+    section leaves the text of every other section unchanged.
+    
+    Args:
+        items: List of transcript items from AWS Transcribe JSON.
+        section_seconds: Length of each section in seconds.
+        
+    Returns:
+        list: Dicts with 'start' (seconds) and 'text' for each non-empty section.
+    """
+    grouped = {}
+    current_index = 0
+    for item in items:
+        try:
+            if item.get('type') == 'pronunciation':
+                current_index = int(float(item.get('start_time', 0)) // section_seconds)
+            grouped.setdefault(current_index, []).append(item)
+        except (KeyError, ValueError):
+            continue
+    
+    return [
+        {'start': index * section_seconds, 'text': _join_items(section_items)}
+        for index, section_items in sorted(grouped.items())
+    ]
+
+def split_text_sections(transcript_text, min_chars=6000, max_chars=12000):
+    """
+    Split a plain transcript without timestamps into sections at sentence boundaries.
+    
+    A section ends at a sentence whose checksum hits a fixed pattern (once the section is at
+    least min_chars long), so boundaries depend on local content rather than absolute offsets
+    and an edit only changes the sections around it.
+    
+    Returns:
+        list: Dicts with 'start' (None, no timing available) and 'text' for each section.
+    """
+    sections = []
+    current = []
+    current_len = 0
+    for sentence in re.split(r'(?<=[.!?])\s+', transcript_text.strip()):
+        if not sentence:
+            continue
+        current.append(sentence)
+        current_len += len(sentence) + 1
+        at_boundary = zlib.crc32(sentence.encode('utf-8')) % 8 == 0
+        if current_len >= max_chars or (current_len >= min_chars and at_boundary):
+            sections.append({'start': None, 'text': ' '.join(current)})
+            current = []
+            current_len = 0
+    if current:
+        sections.append({'start': None, 'text': ' '.join(current)})
+    return sections
+
+def get_summary_store():
+    """Return the store used to memoise hierarchical summary steps."""
+    return open_store(SUMMARY_CACHE_LOCATION)
+
+def _memoized_generate(store, kind, gemini, prompt):
+    """Generate content for prompt, reusing a stored result for the same model and prompt."""
+    model_name = getattr(gemini, 'model_name', '')
+    digest = hashlib.sha256(f"{SUMMARY_PROMPT_VERSION}\n{model_name}\n{prompt}".encode('utf-8')).hexdigest()
+    key = f"{kind}/{digest}.txt"
+    
+    if store is not None:
+        cached = store.get(key)
+        if cached is not None:
+            return cached
+    
+    result = gemini.generate_content(prompt)
+    if store is not None:
+        store.put(key, result)
+    return result
+
+def _section_prompt(section):
+    if section['start'] is None:
+        position = ""
+    else:
+        minutes = int(section['start'] // 60)
+        position = f" starting at {minutes // 60}:{minutes % 60:02d}:00"
+    return f"""Summarise the following section{position} of a longer video transcript. Capture every major point, key detail, name and number so the summary can later be combined with the summaries of the other sections. Write in the same language as the transcript and do not add an introduction or conclusion.
+
+Transcript section:
+{section['text']}"""
+
+def _reduce_sections(sections, gemini, store):
+    """Summarise every section in parallel and combine the results into the long summary."""
+    with ThreadPoolExecutor(max_workers=SUMMARY_SECTION_WORKERS) as executor:
+        section_summaries = list(executor.map(
+            lambda section: _memoized_generate(store, 'sections', gemini, _section_prompt(section)),
+            sections,
+        ))
+    
+    combined = "\n\n".join(
+        f"Section {index + 1}:\n{section_summary}" for index, section_summary in enumerate(section_summaries)
+    )
+    return _memoized_generate(store, 'long', gemini, f"""The following are summaries of consecutive sections of one video transcript. Combine them into a single detailed summary of the whole video. The summary should:
 1. Be around 4-6 paragraphs
 2. Capture all major points and key details
 3. Maintain the logical flow of ideas
 4. Be written in clear, professional language
 5. Be comprehensive enough for someone to understand the full content without watching the video
+Write it in the same language as the section summaries and do not mention the sections themselves.
 
-Transcript:
-{transcript_text}"""
+{combined}""")
 
-        return gemini.generate_content(prompt)
+def _shorten_summary(long_summary, gemini, store):
+    """Derive the short summary from the reduced long summary."""
+    return _memoized_generate(store, 'short', gemini, f"""Generate a very concise 1-2 sentence summary of the following video summary that captures its main point or key takeaway. Keep it under 50 words and use the same language.
+
+Summary:
+{long_summary}""")
+
+def generate_hierarchical_summary(sections, summary_type, gemini=None, store=None):
+    """
+    Summarise a long transcript section by section, then reduce to the final summary.
+    
+    Section summaries are generated in parallel. Every step is memoised in store by a hash
+    of its prompt, so re-running after a small transcript edit only regenerates the sections
+    that changed plus the final reduction.
+    
+    Args:
+        sections: Sections from split_transcript_sections or split_text_sections.
+        summary_type: Either 'short' or 'long'.
+        gemini: Optional GeminiClient to reuse. A new client is created if not provided.
+        store: Optional key/value store for memoisation.
         
+    Returns:
+        str: The requested summary. The short summary is derived from the long one.
+    """
+    gemini = gemini or GeminiClient()
+    long_summary = _reduce_sections(sections, gemini, store)
+    if summary_type == 'long':
+        return long_summary
+    return _shorten_summary(long_summary, gemini, store)
+
+def summary_types_for(event_type):
+    """Summaries produced by one summary event: 'both' produces the short and the long summary."""
+    return ('short', 'long') if event_type == 'both' else (event_type,)
+
+def _transcript_sections(transcript_text, items):
+    return split_transcript_sections(items) if items else split_text_sections(transcript_text)
+
+def summarize_hierarchically(transcript_text, gemini=None, items=None, store=None):
+    """
+    Generate the long and the short summary in one pass over the sections.
+    
+    The sections are summarised and reduced once, and the short summary is derived from that
+    long summary, so nothing is generated twice even without a shared memoisation store.
+    
+    Args:
+        transcript_text: The plain transcript text
+        gemini: Optional GeminiClient to reuse
+        items: Optional transcript items, used for time-bounded sections
+        store: Optional memoisation store, defaults to get_summary_store()
+        
+    Returns:
+        dict: Summary per type ('short' and 'long'); a summary that failed holds its error message
+    """
+    summaries = {summary_type: summary_error_message(summary_type) for summary_type in ('short', 'long')}
+    try:
+        gemini = gemini or GeminiClient()
+        store = store if store is not None else get_summary_store()
+        sections = _transcript_sections(transcript_text, items)
+        print(f"Generating long and short summaries hierarchically from {len(sections)} sections")
+        summaries['long'] = _reduce_sections(sections, gemini, store)
+        summaries['short'] = _shorten_summary(summaries['long'], gemini, store)
     except Exception as e:
-        print(f"Error generating {summary_type} summary: {str(e)}")
-        return f"Error generating {summary_type} summary."
+        print(f"Error generating hierarchical summaries: {str(e)}")
+    return summaries
+
+def summarize_transcript(transcript_text, summary_type, gemini=None, cached_content=None, items=None, store=None):
+    """
+    Generate a summary, choosing between a single prompt and hierarchical summarisation.
+    
+    Args:
+        transcript_text: The plain transcript text
+        summary_type: Either 'short' or 'long'
+        gemini: Optional GeminiClient to reuse
+        cached_content: Optional Gemini cache name holding the transcript (single prompt only)
+        items: Optional transcript items, used for time-bounded sections
+        store: Optional memoisation store, defaults to get_summary_store()
+    """
+    hierarchical = use_hierarchical_summary(transcript_text)
+    if not hierarchical:
+        summary = generate_summary(transcript_text, summary_type, gemini=gemini, cached_content=cached_content)
+        if summary != summary_error_message(summary_type) or SUMMARY_MODE != 'auto':
+            return summary
+        print(f"Single prompt {summary_type} summary failed, retrying hierarchically")
+    
+    try:
+        sections = _transcript_sections(transcript_text, items)
+        print(f"Generating {summary_type} summary hierarchically from {len(sections)} sections")
+        store = store if store is not None else get_summary_store()
+        return generate_hierarchical_summary(sections, summary_type, gemini=gemini, store=store)
+    except Exception as e:
+        print(f"Error generating hierarchical {summary_type} summary: {str(e)}")
+        return summary_error_message(summary_type)
+
+def load_transcript_json(bucket, key):
+    """Load a Transcribe output JSON from S3."""
+    s3 = boto3.client('s3')
+    response = s3.get_object(Bucket=bucket, Key=key)
+    return json.loads(response['Body'].read().decode('utf-8'))
 
 def lambda_handler(event, context):
     try:
@@ -37,25 +308,59 @@ def lambda_handler(event, context):
         
         user_id = event_detail['user_id']
         video_id = event_detail['video_id']
-        transcript_text = event_detail['transcript_text']
+        transcript_text = event_detail.get('transcript_text')
         summary_type = event_detail['summary_type']
+        cached_content = event_detail.get('cached_content')
+        
+        # Skip summaries a previous delivery of this event already stored
+        state = StageState(get_stage_state_store(), user_id, video_id)
+        pending_types = [
+            pending_type for pending_type in summary_types_for(summary_type)
+            if not state.is_done('db_writes', f"{pending_type}_summary")
+        ]
+        if not pending_types:
+            print(f"{summary_type} summary already saved for video {video_id}, nothing to do")
+            return {
+                'statusCode': 200,
+                'body': f"{summary_type} summary already generated"
+            }
         
         print(f"Generating {summary_type} summary for video {video_id}")
         
-        # Generate the summary
-        summary = generate_summary(transcript_text, summary_type)
+        # Long transcripts are left out of the event, and hierarchical summaries use the
+        # item timestamps for their sections, so load the transcript JSON when needed
+        items = None
+        transcript_key = event_detail.get('transcript_key')
+        if transcript_key and (transcript_text is None or summary_type == 'both'
+                               or use_hierarchical_summary(transcript_text)):
+            transcript_json = load_transcript_json(event_detail['transcript_bucket'], transcript_key)
+            if transcript_text is None:
+                transcript_text = transcript_json['results']['transcripts'][0]['transcript']
+            items = transcript_json['results']['items']
         
-        # Update Supabase with the summary
-        try:
-            update_summary(user_id, video_id, summary, summary_type)
-            print(f"Updated document with {summary_type} summary")
-            
-            # Log status update if this is the long summary
-            if summary_type == 'long':
-                print("Document processing marked as completed")
-        except Exception as e:
-            print(f"Error updating Supabase: {str(e)}")
-            raise
+        # Generate the summary. A 'both' event is scheduled for hierarchical summaries, which
+        # produce the short summary from the reduced long one in this same invocation.
+        if summary_type == 'both':
+            summaries = summarize_hierarchically(transcript_text, items=items)
+        else:
+            summaries = {summary_type: summarize_transcript(transcript_text, summary_type, cached_content=cached_content,
+                                                            items=items)}
+        
+        # Update Supabase with the summaries; the long one last, as it marks the document completed
+        for pending_type in pending_types:
+            summary = summaries[pending_type]
+            try:
+                update_summary(user_id, video_id, summary, pending_type)
+                if summary != summary_error_message(pending_type):
+                    state.mark_done('db_writes', f"{pending_type}_summary")
+                print(f"Updated document with {pending_type} summary")
+                
+                # Log status update if this is the long summary
+                if pending_type == 'long':
+                    print("Document processing marked as completed")
+            except Exception as e:
+                print(f"Error updating Supabase: {str(e)}")
+                raise
         
         return {
             'statusCode': 200,
@@ -64,4 +369,4 @@ def lambda_handler(event, context):
         
     except Exception as e:
         print(f"Error in lambda_handler: {str(e)}")
-        raise 
\ No newline at end of file
+        raise
@@ -1,9 +1,13 @@
 import os
 from supabase import create_client, Client
 
+# Reused across invocations in the same process (warm Lambdas, batch workers)
+_supabase_client = None
+
 def get_supabase_client():
     """
     Initialize and return a Supabase client using environment variables.
+    The client is created once per process and reused afterwards.
     
     Returns:
         A Supabase client instance
@@ -11,13 +15,18 @@ def get_supabase_client():
     Raises:
         ValueError: If environment variables are not set
     """
+    global _supabase_client
+    if _supabase_client is not None:
+        return _supabase_client
+    
     supabase_url = os.environ.get("SUPABASE_URL")
     supabase_key = os.environ.get("SUPABASE_SERVICE_KEY")
     
     if not supabase_url or not supabase_key:
         raise ValueError("SUPABASE_URL or SUPABASE_SERVICE_KEY environment variables not set.")
     
-    return create_client(supabase_url, supabase_key)
+    _supabase_client = create_client(supabase_url, supabase_key)
+    return _supabase_client
 
 def update_document(user_id, video_id, update_data):
     """
@@ -49,6 +58,36 @@ def update_document(user_id, video_id, update_data):
         print(f"Error updating Supabase document: {str(e)}")
         raise
 
+def get_document(user_id, video_id):
+    """
+    Fetch a document from Supabase.
+    
+    Args:
+        user_id: The user ID
+        video_id: The video ID
+        
+    Returns:
+        dict: The document row, or None if it does not exist
+        
+    Raises:
+        Exception: If there was an error querying Supabase
+    """
+    try:
+        supabase = get_supabase_client()
+        
+        result = supabase.table("documents") \
+            .select("*") \
+            .eq("user_id", user_id) \
+            .eq("video_id", video_id) \
+            .limit(1) \
+            .execute()
+            
+        return result.data[0] if result.data else None
+        
+    except Exception as e:
+        print(f"Error fetching Supabase document: {str(e)}")
+        raise
+
 def update_chapters(user_id, video_id, chapters):
     """Update document with chapters and set status to processing summaries."""
     update_data = {
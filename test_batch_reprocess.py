@@ -0,0 +1,199 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import json
+import os
+import tempfile
+import batch_reprocess
+from batch_reprocess import (
+    LocalStorage,
+    RateLimiter,
+    RateLimitedGeminiClient,
+    list_transcript_keys,
+    load_completed_keys,
+    parse_location,
+    process_transcript,
+)
+from test_chapter_generator import CaptureOutput
+
+SAMPLE_TRANSCRIPT = {
+    "results": {
+        "transcripts": [{"transcript": "Hello world. Goodbye."}],
+        "items": [
+            {"type": "pronunciation", "start_time": "0.0", "end_time": "0.5", "alternatives": [{"content": "Hello"}]},
+            {"type": "pronunciation", "start_time": "0.6", "end_time": "1.0", "alternatives": [{"content": "world"}]},
+            {"type": "punctuation", "alternatives": [{"content": "."}]},
+            {"type": "pronunciation", "start_time": "95.0", "end_time": "96.0", "alternatives": [{"content": "Goodbye"}]},
+            {"type": "punctuation", "alternatives": [{"content": "."}]},
+        ],
+    }
+}
+
+class TestBatchReprocess(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.storage = LocalStorage(self.root)
+        self.storage.write_text("transcripts/transcribe_user1_video1_1700000000.json", json.dumps(SAMPLE_TRANSCRIPT))
+        self.storage.write_text("transcripts/transcribe_user1_video2_1700000001.json", json.dumps(SAMPLE_TRANSCRIPT))
+        self.storage.write_text("transcripts/transcribe_user1_video1_1700000000.srt", "1\n00:00:00,000 --> 00:00:01,000\nHello")
+        self.storage.write_text("chapters/user1/video0_chapters.txt", "00:00 Old")
+
+        self.gemini = MagicMock()
+        self.gemini.generate_content.return_value = "00:00 Greeting\n01:30 Farewell"
+        batch_reprocess._storage = self.storage
+        batch_reprocess._gemini = self.gemini
+        batch_reprocess._update_db = False
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_parse_location(self):
+        """Test S3 and local locations are split into storage and prefix"""
+        self.assertEqual(parse_location("s3://bucket"), ("s3", "bucket", "transcripts/"))
+        self.assertEqual(parse_location("s3://bucket/transcripts/transcribe_user1"),
+                         ("s3", "bucket", "transcripts/transcribe_user1"))
+        self.assertEqual(parse_location("./out"), ("local", "./out", "transcripts/"))
+
+    def test_list_transcript_keys(self):
+        """Test only transcript JSON files are listed"""
+        keys = list_transcript_keys(self.storage, "transcripts/")
+        self.assertEqual(keys, [
+            "transcripts/transcribe_user1_video1_1700000000.json",
+            "transcripts/transcribe_user1_video2_1700000001.json",
+        ])
+
+    def test_process_transcript_writes_outputs(self):
+        """Test both stages run and write chapters and plain transcript"""
+        entry = process_transcript("transcripts/transcribe_user1_video1_1700000000.json", ["chapters", "summaries"])
+
+        self.assertEqual(entry["status"], "done")
+        self.assertEqual(self.storage.read_text("chapters/user1/video1_chapters.txt"), "00:00 Greeting\n01:30 Farewell")
+        self.assertEqual(self.storage.read_text("plain_text/user1/video1_transcript.txt"), "Hello world. Goodbye.")
+        # One chapter call plus short and long summaries
+        self.assertEqual(self.gemini.generate_content.call_count, 3)
+
+    @patch('batch_reprocess.create_transcript_context', return_value="cachedContents/abc")
+    def test_process_transcript_shares_cached_context(self, mock_create_context):
+        """Test one cached context serves chapters and both summaries and is cleaned up"""
+        with CaptureOutput():
+            process_transcript("transcripts/transcribe_user1_video1_1700000000.json", ["chapters", "summaries"])
+
+        mock_create_context.assert_called_once()
+        for call in self.gemini.generate_content.call_args_list:
+            self.assertEqual(call.kwargs['cached_content'], "cachedContents/abc")
+        self.gemini.delete_cached_context.assert_called_once_with("cachedContents/abc")
+
+    @patch('batch_reprocess.create_transcript_context', return_value="cachedContents/abc")
+    def test_chapters_only_skips_cached_context(self, mock_create_context):
+        """Test a single-request stage sends the transcript inline instead of caching it"""
+        process_transcript("transcripts/transcribe_user1_video1_1700000000.json", ["chapters"])
+
+        mock_create_context.assert_not_called()
+        self.gemini.delete_cached_context.assert_not_called()
+
+    @patch('summary_generator.HIERARCHICAL_SUMMARY_MIN_CHARS', 5)
+    @patch('batch_reprocess.create_transcript_context', return_value="cachedContents/abc")
+    def test_hierarchical_summaries_skip_cached_context(self, mock_create_context):
+        """Test summaries generated from sections do not count as readers of the cached context"""
+        with patch('batch_reprocess.get_summary_store', return_value=None), CaptureOutput():
+            process_transcript("transcripts/transcribe_user1_video1_1700000000.json", ["chapters", "summaries"])
+
+        mock_create_context.assert_not_called()
+
+    def test_process_transcript_summaries_only(self):
+        """Test stage selection skips chapter generation"""
+        entry = process_transcript("transcripts/transcribe_user1_video1_1700000000.json", ["summaries"])
+
+        self.assertEqual(entry["status"], "done")
+        self.assertEqual(self.gemini.generate_content.call_count, 2)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "chapters/user1/video1_chapters.txt")))
+
+    @patch('pipeline.update_summary')
+    @patch('pipeline.update_document')
+    @patch('pipeline.update_chapters')
+    @patch('pipeline.update_transcript')
+    def test_chapters_only_leaves_status(self, mock_transcript, mock_chapters, mock_document, mock_summary):
+        """Test a chapters-only backfill does not reset processing_status"""
+        batch_reprocess._update_db = True
+        process_transcript("transcripts/transcribe_user1_video1_1700000000.json", ["chapters"])
+
+        mock_transcript.assert_called_once_with("user1", "video1", "Hello world. Goodbye.")
+        mock_chapters.assert_not_called()
+        mock_document.assert_called_once_with("user1", "video1", {"chapters": "00:00 Greeting\n01:30 Farewell"})
+        mock_summary.assert_not_called()
+
+    def test_process_transcript_gemini_failure(self):
+        """Test a Gemini failure marks the transcript failed instead of storing fallback chapters"""
+        self.gemini.generate_content.side_effect = Exception("API Error")
+        with CaptureOutput():
+            entry = process_transcript("transcripts/transcribe_user1_video1_1700000000.json", ["chapters"])
+
+        self.assertEqual(entry["status"], "failed")
+        self.assertFalse(os.path.exists(os.path.join(self.root, "chapters/user1/video1_chapters.txt")))
+
+    def test_load_completed_keys(self):
+        """Test the manifest resumes only keys done for every requested stage"""
+        manifest_path = os.path.join(self.root, "manifest.jsonl")
+        with open(manifest_path, "w") as f:
+            f.write(json.dumps({"key": "a", "stages": ["chapters"], "status": "done"}) + "\n")
+            f.write(json.dumps({"key": "a", "stages": ["summaries"], "status": "done"}) + "\n")
+            f.write(json.dumps({"key": "b", "stages": ["chapters", "summaries"], "status": "failed"}) + "\n")
+            f.write(json.dumps({"key": "c", "stages": ["chapters"], "status": "done"}) + "\n")
+            f.write('{"key": "d", "sta')
+
+        self.assertEqual(load_completed_keys(manifest_path, ["chapters", "summaries"]), {"a"})
+        self.assertEqual(load_completed_keys(manifest_path, ["chapters"]), {"a", "c"})
+
+    def test_dry_run_skips_completed(self):
+        """Test dry run lists pending transcripts and does not start a pool"""
+        manifest_path = os.path.join(self.root, "manifest.jsonl")
+        with open(manifest_path, "w") as f:
+            f.write(json.dumps({"key": "transcripts/transcribe_user1_video1_1700000000.json",
+                                "stages": ["chapters", "summaries"], "status": "done"}) + "\n")
+
+        with patch('batch_reprocess.run_batch') as mock_run, CaptureOutput() as output:
+            result = batch_reprocess.main([self.root, "--manifest", manifest_path, "--dry-run"])
+
+        self.assertEqual(result, 0)
+        mock_run.assert_not_called()
+        stdout = output.stdout.getvalue()
+        self.assertIn("1 already done, 1 to process", stdout)
+        self.assertIn("transcribe_user1_video2_1700000001.json", stdout)
+        self.assertNotIn("transcribe_user1_video1_1700000000.json", stdout)
+
+class TestRateLimiter(unittest.TestCase):
+    @patch('batch_reprocess.time')
+    def test_slots_are_spaced(self, mock_time):
+        """Test consecutive acquisitions wait for evenly spaced slots"""
+        mock_time.time.return_value = 100.0
+        limiter = RateLimiter(requests_per_minute=60)
+
+        limiter.acquire()
+        limiter.acquire()
+        limiter.acquire()
+
+        sleeps = [call.args[0] for call in mock_time.sleep.call_args_list]
+        self.assertEqual(sleeps, [1.0, 2.0])
+
+    def test_cache_calls_are_limited(self):
+        """Test context cache creation and deletion take rate limiter slots"""
+        gemini = MagicMock()
+        limiter = MagicMock()
+        client = RateLimitedGeminiClient(gemini, limiter)
+
+        client.create_cached_context("text")
+        client.delete_cached_context("cachedContents/abc")
+
+        self.assertEqual(limiter.acquire.call_count, 2)
+        gemini.create_cached_context.assert_called_once_with("text")
+        gemini.delete_cached_context.assert_called_once_with("cachedContents/abc")
+
+    def test_unlimited(self):
+        """Test a zero rate never blocks"""
+        gemini = MagicMock()
+        client = RateLimitedGeminiClient(gemini, RateLimiter(0))
+        client.generate_content("prompt")
+        gemini.generate_content.assert_called_once_with("prompt")
+
+if __name__ == '__main__':
+    unittest.main(verbose=2)
@@ -3,7 +3,17 @@ from unittest.mock import patch, MagicMock
 import os
 import io
 import sys
-from chapter_generator import GeminiClient, generate_chapters_with_gemini
+import json
+import tempfile
+from chapter_generator import (
+    FALLBACK_CHAPTERS,
+    GeminiClient,
+    context_cache_min_chars,
+    create_transcript_context,
+    generate_chapters_with_gemini,
+    lambda_handler,
+)
+from kv_store import LocalFileStore
 
 class CaptureOutput:
     """Context manager to capture stdout and stderr"""
@@ -90,6 +100,24 @@ class TestGeminiClient(unittest.TestCase):
         
         self.assertEqual(response, "Test response")
 
+    @patch('google.genai.Client')
+    def test_generate_content_with_cached_context(self, mock_genai_client):
+        """Test cached context is created once and referenced in the request config"""
+        mock_genai_client.return_value.caches.create.return_value.name = "cachedContents/abc"
+        mock_response = MagicMock()
+        mock_response.text = "Test response"
+        mock_genai_client.return_value.models.generate_content.return_value = mock_response
+        
+        client = GeminiClient()
+        cache_name = client.create_cached_context("Transcript text", ttl_seconds=600)
+        client.generate_content("Test prompt", stream=False, cached_content=cache_name)
+        
+        self.assertEqual(cache_name, "cachedContents/abc")
+        create_config = mock_genai_client.return_value.caches.create.call_args.kwargs['config']
+        self.assertEqual(create_config.ttl, "600s")
+        generate_config = mock_genai_client.return_value.models.generate_content.call_args.kwargs['config']
+        self.assertEqual(generate_config.cached_content, "cachedContents/abc")
+
 class TestChapterGeneration(unittest.TestCase):
     def setUp(self):
         # Mock environment variables
@@ -152,5 +180,178 @@ class TestChapterGeneration(unittest.TestCase):
         # Verify error message was logged
         self.assertIn("Error during chapter generation: API Error", output.stdout.getvalue())
 
+    @patch.object(GeminiClient, 'generate_content')
+    def test_generate_chapters_with_cached_context(self, mock_generate_content):
+        """Test the transcript is not resent when it is already cached"""
+        mock_generate_content.return_value = "00:00 Introduction to Python"
+        
+        with CaptureOutput():
+            generate_chapters_with_gemini(self.sample_transcript, 15, cached_content="cachedContents/abc")
+        
+        prompt = mock_generate_content.call_args[0][0]
+        self.assertNotIn(self.sample_transcript, prompt)
+        self.assertIn("provided in the context above", prompt)
+        self.assertEqual(mock_generate_content.call_args.kwargs['cached_content'], "cachedContents/abc")
+
+    @patch.object(GeminiClient, 'generate_content')
+    def test_generate_chapters_expired_cache(self, mock_generate_content):
+        """Test an unusable cache falls back to sending the transcript inline"""
+        mock_generate_content.side_effect = [Exception("Cache expired"), "00:00 Introduction to Python"]
+        
+        with CaptureOutput():
+            result = generate_chapters_with_gemini(self.sample_transcript, 15, cached_content="cachedContents/abc")
+        
+        self.assertEqual(result, "00:00 Introduction to Python")
+        self.assertIn(self.sample_transcript, mock_generate_content.call_args[0][0])
+
+    @patch.object(GeminiClient, 'create_cached_context')
+    def test_create_transcript_context(self, mock_create_cached_context):
+        """Test only transcripts long enough for Gemini caching are cached"""
+        mock_create_cached_context.return_value = "cachedContents/abc"
+        
+        with CaptureOutput():
+            self.assertIsNone(create_transcript_context(self.sample_transcript))
+            self.assertEqual(create_transcript_context(self.sample_transcript * 1000), "cachedContents/abc")
+            mock_create_cached_context.side_effect = Exception("Too few tokens")
+            self.assertIsNone(create_transcript_context(self.sample_transcript * 1000))
+        
+        self.assertEqual(mock_create_cached_context.call_count, 2)
+
+    @patch.object(GeminiClient, 'create_cached_context')
+    def test_cache_minimum_follows_model(self, mock_create_cached_context):
+        """Test the cache minimum depends on the model and aliases are never cached"""
+        self.assertEqual(context_cache_min_chars("gemini-1.5-pro-002"), 32768 * 4)
+        self.assertEqual(context_cache_min_chars("models/gemini-2.5-flash"), 1024 * 4)
+        self.assertIsNone(context_cache_min_chars("gemini-1.5-pro-latest"))
+        
+        # About 40k tokens; the first 100k characters (about 25k tokens) are too short for 1.5 models
+        transcript = "x" * 160000
+        with CaptureOutput():
+            self.assertIsNone(create_transcript_context(transcript, gemini=GeminiClient(model_name="gemini-1.5-pro-latest")))
+            self.assertIsNone(create_transcript_context(transcript[:100000], gemini=GeminiClient(model_name="gemini-1.5-pro-002")))
+            create_transcript_context(transcript, gemini=GeminiClient(model_name="gemini-1.5-pro-002"))
+        
+        mock_create_cached_context.assert_called_once()
+
+class TestLambdaHandlerCheckpointing(unittest.TestCase):
+    def setUp(self):
+        self.env_patcher = patch.dict('os.environ', {
+            'GEMINI_API_KEY': 'test_api_key',
+            'GEMINI_MODEL_NAME': 'test_model'
+        })
+        self.env_patcher.start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store_patcher = patch('chapter_generator.get_stage_state_store',
+                                   return_value=LocalFileStore(self.tmp.name))
+        self.store_patcher.start()
+        
+        transcript = {
+            "results": {
+                "transcripts": [{"transcript": "Hello world."}],
+                "items": [
+                    {"type": "pronunciation", "start_time": "0.0", "end_time": "0.5", "alternatives": [{"content": "Hello"}]},
+                    {"type": "pronunciation", "start_time": "0.6", "end_time": "1.0", "alternatives": [{"content": "world"}]},
+                    {"type": "punctuation", "alternatives": [{"content": "."}]},
+                ],
+            }
+        }
+        self.s3 = MagicMock()
+        self.s3.get_object.side_effect = lambda **kwargs: {"Body": io.BytesIO(json.dumps(transcript).encode("utf-8"))}
+        self.events = MagicMock()
+        self.boto_patcher = patch('chapter_generator.boto3.client',
+                                  side_effect=lambda service, **kwargs: self.s3 if service == 's3' else self.events)
+        self.boto_patcher.start()
+        
+        self.event = {"Records": [{"s3": {
+            "bucket": {"name": "transcripts-bucket"},
+            "object": {"key": "transcripts/transcribe_user1_video1_1700000000.json", "size": 1024, "eTag": "abc123"},
+        }}]}
+        
+    def tearDown(self):
+        self.boto_patcher.stop()
+        self.store_patcher.stop()
+        self.env_patcher.stop()
+        self.tmp.cleanup()
+
+    @patch('chapter_generator.update_chapters')
+    @patch('chapter_generator.update_transcript')
+    @patch.object(GeminiClient, 'generate_content')
+    def test_retry_resumes_after_supabase_failure(self, mock_generate_content, mock_update_transcript, mock_update_chapters):
+        """Test a retry after a Supabase failure only repeats the failed write and what follows it"""
+        mock_generate_content.return_value = "00:00 Greeting"
+        mock_update_chapters.side_effect = [Exception("Supabase unavailable"), True]
+        
+        with CaptureOutput():
+            with self.assertRaises(Exception):
+                lambda_handler(self.event, None)
+            puts_after_first_attempt = self.s3.put_object.call_count
+            
+            result = lambda_handler(self.event, None)
+        
+        self.assertEqual(result['statusCode'], 200)
+        mock_generate_content.assert_called_once()
+        mock_update_transcript.assert_called_once()
+        self.assertEqual(mock_update_chapters.call_count, 2)
+        self.assertEqual(mock_update_chapters.call_args[0][2], "00:00 Greeting")
+        self.assertEqual(self.s3.put_object.call_count, puts_after_first_attempt)
+        self.assertEqual(self.events.put_events.call_count, 2)
+        # The retry neither downloads the transcript nor embeds it; summaries load it from S3
+        self.s3.get_object.assert_called_once()
+        detail = json.loads(self.events.put_events.call_args.kwargs['Entries'][0]['Detail'])
+        self.assertIsNone(detail['transcript_text'])
+        self.assertEqual(detail['transcript_key'], "transcripts/transcribe_user1_video1_1700000000.json")
+
+    @patch('chapter_generator.update_chapters')
+    @patch('chapter_generator.update_transcript')
+    @patch.object(GeminiClient, 'generate_content')
+    def test_retry_replaces_placeholder_chapters(self, mock_generate_content, mock_update_transcript, mock_update_chapters):
+        """Test placeholder chapters written on a Gemini failure are overwritten when a retry gets real ones"""
+        mock_generate_content.side_effect = [Exception("API Error"), "00:00 Greeting"]
+        mock_update_transcript.side_effect = [Exception("Supabase unavailable"), True]
+        
+        with CaptureOutput():
+            with self.assertRaises(Exception):
+                lambda_handler(self.event, None)
+            lambda_handler(self.event, None)
+        
+        chapter_writes = [call.kwargs['Body'] for call in self.s3.put_object.call_args_list
+                          if call.kwargs['Key'] == "chapters/user1/video1_chapters.txt"]
+        self.assertEqual(chapter_writes, [FALLBACK_CHAPTERS, "00:00 Greeting"])
+        mock_update_chapters.assert_called_once_with("user1", "video1", "00:00 Greeting")
+    
+    @patch('summary_generator.HIERARCHICAL_SUMMARY_MIN_CHARS', 5)
+    @patch('chapter_generator.update_chapters')
+    @patch('chapter_generator.update_transcript')
+    @patch.object(GeminiClient, 'generate_content')
+    def test_hierarchical_summaries_share_one_event(self, mock_generate_content, mock_update_transcript, mock_update_chapters):
+        """Test long transcripts get a single summary event producing both summaries"""
+        mock_generate_content.return_value = "00:00 Greeting"
+        
+        with CaptureOutput():
+            lambda_handler(self.event, None)
+            result = lambda_handler(self.event, None)
+        
+        self.assertEqual(result['body'], "Processing already complete.")
+        self.events.put_events.assert_called_once()
+        detail = json.loads(self.events.put_events.call_args.kwargs['Entries'][0]['Detail'])
+        self.assertEqual(detail['summary_type'], 'both')
+    
+    @patch('chapter_generator.update_chapters')
+    @patch('chapter_generator.update_transcript')
+    @patch.object(GeminiClient, 'generate_content')
+    def test_duplicate_event_skips_download(self, mock_generate_content, mock_update_transcript, mock_update_chapters):
+        """Test a redelivered event for a finished transcript does no work"""
+        mock_generate_content.return_value = "00:00 Greeting"
+        
+        with CaptureOutput():
+            lambda_handler(self.event, None)
+            self.s3.get_object.reset_mock()
+            result = lambda_handler(self.event, None)
+        
+        self.assertEqual(result['body'], "Processing already complete.")
+        self.s3.get_object.assert_not_called()
+        mock_generate_content.assert_called_once()
+        self.assertEqual(self.events.put_events.call_count, 2)
+
 if __name__ == '__main__':
     unittest.main(verbose=2)  # Use verbose output for better test reporting 
\ No newline at end of file
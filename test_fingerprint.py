@@ -0,0 +1,242 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import subprocess
+import tempfile
+import numpy as np
+import lambda_function
+from fingerprint import SAMPLE_RATE, FingerprintIndex, compute_fingerprint, decode_audio, durations_match, media_duration
+
+MATCH_THRESHOLD = lambda_function.FINGERPRINT_MATCH_THRESHOLD
+from test_chapter_generator import CaptureOutput
+
+def synth_recording(seed, seconds=30):
+    """Speech-like test audio: a new random chord of tones every quarter second."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(SAMPLE_RATE * 0.25)) / SAMPLE_RATE
+    segments = []
+    for _ in range(seconds * 4):
+        frequencies = rng.uniform(150, 3500, size=3)
+        segments.append(sum(np.sin(2 * np.pi * f * t) for f in frequencies) / 3)
+    return np.concatenate(segments).astype(np.float32)
+
+def reencode(samples, seed=0):
+    """Approximate a lossy re-export: level change, added noise and a smoothed high end."""
+    rng = np.random.default_rng(seed)
+    noisy = 0.7 * samples + rng.normal(0, 0.05, len(samples)).astype(np.float32)
+    return np.convolve(noisy, np.ones(3, dtype=np.float32) / 3, mode='same')
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.original = synth_recording(seed=1)
+        self.index = FingerprintIndex()
+        hashes, times = compute_fingerprint(self.original)
+        self.index.add("video1", hashes, times, {"video_id": "video1"})
+
+    def test_reencoded_copy_matches(self):
+        """Test a re-encoded copy matches the original"""
+        match = self.index.query(*compute_fingerprint(reencode(self.original)), min_score=MATCH_THRESHOLD)
+        self.assertIsNotNone(match)
+        self.assertEqual(match[0], "video1")
+        self.assertEqual(match[2], {"video_id": "video1"})
+
+    def test_trimmed_copy_matches(self):
+        """Test a copy missing its first seconds still matches at a shifted offset"""
+        trimmed = self.original[SAMPLE_RATE * 5:]
+        match = self.index.query(*compute_fingerprint(trimmed), min_score=MATCH_THRESHOLD)
+        self.assertEqual(match[0], "video1")
+
+    def test_different_recording_does_not_match(self):
+        """Test unrelated audio scores below the threshold"""
+        hashes, times = compute_fingerprint(synth_recording(seed=2))
+        self.assertIsNone(self.index.query(hashes, times, min_score=MATCH_THRESHOLD))
+
+    def test_shared_intro_does_not_match(self):
+        """Test two different episodes that open with the same intro are not duplicates"""
+        intro = synth_recording(seed=9, seconds=10)
+        episode1 = np.concatenate([intro, synth_recording(seed=3, seconds=170)])
+        episode2 = np.concatenate([intro, synth_recording(seed=4, seconds=170)])
+        index = FingerprintIndex()
+        index.add("episode1", *compute_fingerprint(episode1), duration=180.0)
+
+        hashes, times = compute_fingerprint(reencode(episode2))
+        # The intro aligns perfectly but covers only a small share of the window
+        self.assertLess(index.query(hashes, times, duration=180.0)[1], 0.15)
+        self.assertIsNone(index.query(hashes, times, min_score=MATCH_THRESHOLD, duration=180.0))
+
+    def test_duration_mismatch_does_not_match(self):
+        """Test a recording whose duration differs from the indexed one is not compared"""
+        index = FingerprintIndex()
+        hashes, times = compute_fingerprint(self.original)
+        index.add("video1", hashes, times, duration=600.0)
+
+        self.assertIsNone(index.query(hashes, times, duration=1800.0))
+        self.assertEqual(index.query(hashes, times, duration=605.0)[0], "video1")
+        self.assertTrue(durations_match(3600.0, 3700.0))
+        self.assertFalse(durations_match(600.0, None))
+
+    def test_exclude_and_remove(self):
+        """Test an entry can be excluded from a query and removed from the index"""
+        hashes, times = compute_fingerprint(self.original)
+        self.assertIsNone(self.index.query(hashes, times, exclude="video1"))
+        self.index.remove("video1")
+        self.assertIsNone(self.index.query(hashes, times))
+
+    def test_json_round_trip(self):
+        """Test the index survives serialisation"""
+        restored = FingerprintIndex.from_json(self.index.to_json())
+        match = restored.query(*compute_fingerprint(self.original))
+        self.assertEqual(match[0], "video1")
+        self.assertEqual(match[1], 1.0)
+
+    def test_trim_drops_oldest(self):
+        """Test trimming keeps only the most recently added entries"""
+        hashes, times = compute_fingerprint(self.original)
+        self.index.add("video2", hashes[:100], times[:100])
+        self.index.add("video3", hashes[100:200], times[100:200])
+
+        self.index.trim(2)
+
+        self.assertEqual(list(self.index.entries), ["video2", "video3"])
+        restored = FingerprintIndex.from_json(self.index.to_json())
+        self.assertEqual(restored.query(hashes[100:200], times[100:200])[0], "video3")
+
+    @patch('fingerprint.subprocess.run', side_effect=subprocess.TimeoutExpired("ffmpeg", 60))
+    def test_stalled_ffmpeg_raises(self, mock_run):
+        """Test a hung ffmpeg is stopped and reported as an ordinary fingerprinting failure"""
+        with self.assertRaises(RuntimeError):
+            decode_audio("https://bucket.s3.amazonaws.com/video.mp4")
+        with self.assertRaises(RuntimeError):
+            media_duration("https://bucket.s3.amazonaws.com/video.mp4")
+        self.assertTrue(all(call.kwargs['timeout'] for call in mock_run.call_args_list))
+
+    def test_silence_has_no_landmarks(self):
+        """Test silence produces an empty fingerprint"""
+        hashes, times = compute_fingerprint(np.zeros(SAMPLE_RATE * 5, dtype=np.float32))
+        self.assertEqual(len(hashes), 0)
+        self.assertEqual(len(times), 0)
+
+class TestUploadDeduplication(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env_patcher = patch.dict('os.environ', {'OUTPUT_BUCKET': 'output-bucket'})
+        self.env_patcher.start()
+        self.location_patcher = patch('lambda_function.FINGERPRINT_INDEX_LOCATION', self.tmp.name)
+        self.location_patcher.start()
+        self.duration_patcher = patch('lambda_function.media_duration', return_value=1800.0)
+        self.duration_patcher.start()
+        self.boto3_patcher = patch('lambda_function.boto3')
+        mock_boto3 = self.boto3_patcher.start()
+        self.s3 = MagicMock()
+        self.transcribe = MagicMock()
+        mock_boto3.client.side_effect = lambda service, **kwargs: self.s3 if service == 's3' else self.transcribe
+        self.recording = synth_recording(seed=1)
+
+    def tearDown(self):
+        self.boto3_patcher.stop()
+        self.duration_patcher.stop()
+        self.location_patcher.stop()
+        self.env_patcher.stop()
+        self.tmp.cleanup()
+
+    def upload(self, video_id):
+        event = {'Records': [{'s3': {'bucket': {'name': 'raw-bucket'},
+                                     'object': {'key': f'raw-media/user1/{video_id}.mp4'}}}]}
+        with CaptureOutput():
+            return lambda_function.lambda_handler(event, None)
+
+    @patch('lambda_function.update_document')
+    @patch('lambda_function.get_document')
+    @patch('lambda_function.decode_audio')
+    def test_reupload_copies_results(self, mock_decode, mock_get_document, mock_update_document):
+        """Test a re-encoded re-upload reuses the earlier video's results without transcribing"""
+        mock_decode.return_value = self.recording
+        self.assertEqual(self.upload("video1")['body']['status'], 'started')
+
+        mock_decode.return_value = reencode(self.recording)
+        mock_get_document.return_value = {
+            "processing_status": "completed",
+            "transcription": "Hello world.",
+            "chapters": "00:00 Intro",
+            "short_summary": "Short",
+            "long_summary": "Long",
+        }
+        result = self.upload("video2")
+
+        self.assertEqual(result['body']['status'], 'deduplicated')
+        self.assertEqual(result['body']['sourceVideoId'], 'video1')
+        self.transcribe.start_transcription_job.assert_called_once()
+        mock_get_document.assert_called_once_with("user1", "video1")
+        mock_update_document.assert_called_once_with("user1", "video2", {
+            "transcription": "Hello world.",
+            "chapters": "00:00 Intro",
+            "short_summary": "Short",
+            "long_summary": "Long",
+            "processing_status": "completed",
+        })
+        copied = {call.kwargs['Key']: call.kwargs['CopySource']['Key'] for call in self.s3.copy_object.call_args_list}
+        self.assertTrue(copied["deduplicated/user1/video2_transcript.json"].startswith("transcripts/transcribe_user1_video1_"))
+        self.assertEqual(copied["chapters/user1/video2_chapters.txt"], "chapters/user1/video1_chapters.txt")
+        self.assertEqual(copied["plain_text/user1/video2_transcript.txt"], "plain_text/user1/video1_transcript.txt")
+
+    @patch('lambda_function.update_document')
+    @patch('lambda_function.get_document')
+    @patch('lambda_function.decode_audio')
+    def test_unfinished_match_is_transcribed(self, mock_decode, mock_get_document, mock_update_document):
+        """Test a match whose original is still processing is transcribed normally"""
+        mock_decode.return_value = self.recording
+        self.upload("video1")
+        mock_get_document.return_value = {"processing_status": "processing"}
+
+        result = self.upload("video2")
+
+        self.assertEqual(result['body']['status'], 'started')
+        self.assertEqual(self.transcribe.start_transcription_job.call_count, 2)
+        mock_update_document.assert_not_called()
+
+    @patch('lambda_function.update_document')
+    @patch('lambda_function.get_document', return_value={"processing_status": "completed"})
+    @patch('lambda_function.decode_audio')
+    def test_failed_copy_is_transcribed(self, mock_decode, mock_get_document, mock_update_document):
+        """Test a match whose files cannot be copied is transcribed instead of marked completed"""
+        mock_decode.return_value = self.recording
+        self.upload("video1")
+        self.s3.copy_object.side_effect = [None, Exception("NoSuchKey")]
+
+        result = self.upload("video2")
+
+        self.assertEqual(result['body']['status'], 'started')
+        self.assertEqual(self.transcribe.start_transcription_job.call_count, 2)
+        mock_update_document.assert_not_called()
+
+    @patch('lambda_function.decode_audio')
+    def test_concurrent_uploads_keep_both_fingerprints(self, mock_decode):
+        """Test two uploads updating the same index at once both end up indexed"""
+        mock_decode.side_effect = [self.recording, synth_recording(seed=2)]
+        real_query = FingerprintIndex.query
+
+        def racing_query(index, *args, **kwargs):
+            # Another upload of the same user finishes between our read and write
+            if mock_decode.call_count == 1:
+                with CaptureOutput():
+                    lambda_function.deduplicate_upload(self.s3, 'raw-bucket', 'raw-media/user1/video2.mp4',
+                                                       'user1', 'video2', 'job2')
+            return real_query(index, *args, **kwargs)
+
+        with patch.object(FingerprintIndex, 'query', racing_query), CaptureOutput() as output:
+            lambda_function.deduplicate_upload(self.s3, 'raw-bucket', 'raw-media/user1/video1.mp4',
+                                               'user1', 'video1', 'job1')
+
+        self.assertIn("retrying", output.stdout.getvalue())
+        with open(f"{self.tmp.name}/user1.json") as f:
+            index = FingerprintIndex.from_json(f.read())
+        self.assertEqual(set(index.entries), {"video1", "video2"})
+
+    @patch('lambda_function.decode_audio', side_effect=RuntimeError("ffmpeg not found at ffmpeg"))
+    def test_missing_ffmpeg_still_transcribes(self, mock_decode):
+        """Test fingerprinting failures never block transcription"""
+        result = self.upload("video1")
+        self.assertEqual(result['body']['status'], 'started')
+        self.transcribe.start_transcription_job.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main(verbose=2)
@@ -0,0 +1,218 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import os
+import subprocess
+import sys
+import tempfile
+import boto3
+from ingest_api import (
+    MIB,
+    MIN_PART_SIZE,
+    IngestAPI,
+    LocalS3,
+    checksum_sha256,
+    choose_part_size,
+    composite_checksum,
+    create_s3_client,
+    lambda_handler,
+    start_transcription,
+    upload_file,
+)
+from kv_store import LocalFileStore
+from test_chapter_generator import CaptureOutput
+
+class TestPartSizing(unittest.TestCase):
+    def test_small_files_use_minimum_part(self):
+        """Test files up to a few GB use S3's minimum part size"""
+        self.assertEqual(choose_part_size(1), MIN_PART_SIZE)
+        self.assertEqual(choose_part_size(2 * 1024 * MIB), MIN_PART_SIZE)
+
+    def test_large_files_scale_parts(self):
+        """Test part size grows with the file and stays within S3's part limit"""
+        size = 50 * 1024 * MIB
+        part_size = choose_part_size(size)
+        self.assertGreater(part_size, MIN_PART_SIZE)
+        self.assertEqual(part_size % MIB, 0)
+        self.assertLessEqual(-(-size // part_size), 10000)
+
+    def test_invalid_sizes(self):
+        """Test empty and oversized files are rejected"""
+        with self.assertRaises(ValueError):
+            choose_part_size(0)
+        with self.assertRaises(ValueError):
+            choose_part_size(6 * 1024 ** 4)
+
+class TestIngestAPI(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.s3 = LocalS3()
+        self.on_complete = MagicMock()
+        self.api = IngestAPI(self.s3, LocalFileStore(os.path.join(self.tmp.name, "state")), "raw-bucket",
+                             on_complete=self.on_complete)
+
+        # Three parts: two full and a short last one
+        self.data = os.urandom(2 * MIN_PART_SIZE + 1234)
+        self.path = os.path.join(self.tmp.name, "video.mp4")
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+        self.sent = []
+
+        def send_part(url, data, checksum):
+            self.sent.append(int(url.split("partNumber=")[1].split("&")[0]))
+            return self.s3.put_presigned(url, data, checksum)
+        self.send_part = send_part
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def upload(self, send_part=None):
+        with CaptureOutput():
+            return upload_file(self.api, self.path, "user1", "video1", max_workers=3,
+                               send_part=send_part or self.send_part)
+
+    def test_parallel_upload_completes(self):
+        """Test all parts are sent, assembled in order and transcription is triggered"""
+        result = self.upload()
+
+        self.assertEqual(sorted(self.sent), [1, 2, 3])
+        self.assertEqual(result["key"], "raw-media/user1/video1.mp4")
+        self.assertEqual(self.s3.objects[("raw-bucket", "raw-media/user1/video1.mp4")], self.data)
+        self.on_complete.assert_called_once_with("raw-bucket", "raw-media/user1/video1.mp4")
+
+    def test_resume_sends_only_missing_parts(self):
+        """Test an interrupted upload resumes the same upload and resends only missing parts"""
+        def flaky_send(url, data, checksum):
+            if "partNumber=2" in url:
+                raise ConnectionError("connection reset")
+            return self.send_part(url, data, checksum)
+
+        with patch('ingest_api.time.sleep'):
+            with self.assertRaises(ConnectionError):
+                self.upload(send_part=flaky_send)
+        self.on_complete.assert_not_called()
+        upload_id = self.api.create_upload("user1", "video1", len(self.data))["upload_id"]
+        self.assertEqual(self.api.resume_upload(upload_id)["missing_parts"], [2])
+
+        self.sent.clear()
+        self.upload()
+
+        self.assertEqual(self.sent, [2])
+        self.assertEqual(self.s3.objects[("raw-bucket", "raw-media/user1/video1.mp4")], self.data)
+
+    def test_failed_part_is_retried(self):
+        """Test a transient part failure retries only that part"""
+        failures = []
+
+        def send_once_failing(url, data, checksum):
+            if "partNumber=3" in url and not failures:
+                failures.append(url)
+                raise ConnectionError("timeout")
+            return self.send_part(url, data, checksum)
+
+        with patch('ingest_api.time.sleep'):
+            self.upload(send_part=send_once_failing)
+
+        self.assertEqual(sorted(self.sent), [1, 2, 3])
+        self.on_complete.assert_called_once()
+
+    def test_checksum_mismatch_refuses_completion(self):
+        """Test completion is refused when parts do not add up to the client's checksum"""
+        with CaptureOutput():
+            plan = self.api.create_upload("user1", "video1", len(self.data))
+            for number, offset in ((1, 0), (2, MIN_PART_SIZE), (3, 2 * MIN_PART_SIZE)):
+                data = self.data[offset:offset + MIN_PART_SIZE]
+                url = self.api.presign_parts(plan["upload_id"], {number: checksum_sha256(data)})[number]
+                self.s3.put_presigned(url, data)
+
+            with self.assertRaises(ValueError):
+                self.api.complete_upload(plan["upload_id"], expected_checksum=composite_checksum(
+                    [checksum_sha256(b"a"), checksum_sha256(b"b"), checksum_sha256(b"c")]))
+
+        self.assertEqual(self.s3.objects, {})
+        self.on_complete.assert_not_called()
+
+    def test_signed_checksum_rejects_corrupt_part(self):
+        """Test a part whose bytes differ from its signed checksum is rejected"""
+        with CaptureOutput():
+            plan = self.api.create_upload("user1", "video1", len(self.data))
+        url = self.api.presign_parts(plan["upload_id"], {1: checksum_sha256(b"expected")})[1]
+        with self.assertRaises(ValueError):
+            self.s3.put_presigned(url, b"corrupted")
+
+    def test_complete_with_missing_parts(self):
+        """Test completion before all parts arrive is refused"""
+        with CaptureOutput():
+            plan = self.api.create_upload("user1", "video1", len(self.data))
+        with self.assertRaises(ValueError):
+            self.api.complete_upload(plan["upload_id"])
+
+    def test_new_file_replaces_unfinished_upload(self):
+        """Test a different file size aborts the unfinished upload and starts a new one"""
+        with CaptureOutput():
+            first = self.api.create_upload("user1", "video1", len(self.data))
+            second = self.api.create_upload("user1", "video1", len(self.data) + 1)
+
+        self.assertNotEqual(first["upload_id"], second["upload_id"])
+        with self.assertRaises(ValueError):
+            self.api.resume_upload(first["upload_id"])
+
+    def test_invalid_ids_rejected(self):
+        """Test IDs that would escape the raw-media key layout are rejected"""
+        with self.assertRaises(ValueError):
+            self.api.create_upload("user1/../other", "video1", 100)
+
+class TestPresignedUrlSigning(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = LocalFileStore(self.tmp.name)
+        self.store.put("upload1.json", '{"upload_id": "upload1", "bucket": "raw-bucket", '
+                                       '"key": "raw-media/user1/video1.mp4", "part_count": 3, "status": "uploading"}')
+        self.env_patcher = patch.dict('os.environ', {'AWS_ACCESS_KEY_ID': 'AKIDEXAMPLE',
+                                                     'AWS_SECRET_ACCESS_KEY': 'secret',
+                                                     'AWS_DEFAULT_REGION': 'us-east-1'})
+        self.env_patcher.start()
+
+    def tearDown(self):
+        self.env_patcher.stop()
+        self.tmp.cleanup()
+
+    def test_checksum_is_a_signed_header(self):
+        """Test part URLs from the ingest S3 client are SigV4 and sign the checksum header"""
+        api = IngestAPI(create_s3_client(), self.store, "raw-bucket")
+        url = api.presign_parts("upload1", {1: checksum_sha256(b"part")})[1]
+
+        self.assertIn("X-Amz-Algorithm=AWS4-HMAC-SHA256", url)
+        self.assertIn("x-amz-checksum-sha256", url.split("X-Amz-SignedHeaders=")[1].split("&")[0])
+
+    def test_unsigned_checksum_is_refused(self):
+        """Test a client that would leave the checksum unsigned cannot issue part URLs"""
+        api = IngestAPI(boto3.client('s3'), self.store, "raw-bucket")
+        with self.assertRaises(RuntimeError):
+            api.presign_parts("upload1", {1: checksum_sha256(b"part")})
+
+class TestIngestHandler(unittest.TestCase):
+    def test_import_skips_transcription_handler(self):
+        """Test the ingest Lambda does not load the transcription handler at startup"""
+        result = subprocess.run([sys.executable, "-c", "import sys, ingest_api; print('lambda_function' in sys.modules)"],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        self.assertEqual(result.stdout.strip(), "False")
+
+    @patch('lambda_function.lambda_handler', return_value={'statusCode': 200})
+    def test_start_transcription_event(self, mock_handler):
+        """Test the synthesized event matches an S3 notification record"""
+        start_transcription("raw-bucket", "raw-media/user1/video1.mp4")
+        event = mock_handler.call_args.args[0]
+        self.assertEqual(event['Records'][0]['s3']['bucket']['name'], "raw-bucket")
+        self.assertEqual(event['Records'][0]['s3']['object']['key'], "raw-media/user1/video1.mp4")
+
+    @patch.dict('os.environ', {'RAW_MEDIA_BUCKET': 'raw-bucket'})
+    @patch('ingest_api.boto3')
+    def test_unknown_action(self, mock_boto3):
+        """Test bad requests return 400"""
+        with CaptureOutput():
+            response = lambda_handler({'action': 'explode'}, None)
+        self.assertEqual(response['statusCode'], 400)
+
+if __name__ == '__main__':
+    unittest.main(verbose=2)
@@ -0,0 +1,35 @@
+import unittest
+from unittest.mock import MagicMock
+import tempfile
+from botocore.exceptions import ClientError
+from kv_store import LocalFileStore, S3Store
+
+class TestConditionalWrites(unittest.TestCase):
+    def test_local_put_if_version(self):
+        """Test a conditional write fails once another writer changed the value"""
+        with tempfile.TemporaryDirectory() as root:
+            store = LocalFileStore(root)
+            self.assertTrue(store.put_if_version("user1.json", "first", None))
+            self.assertFalse(store.put_if_version("user1.json", "again", None))
+
+            value, version = store.get_versioned("user1.json")
+            self.assertEqual(value, "first")
+            self.assertTrue(store.put_if_version("user1.json", "second", version))
+            self.assertFalse(store.put_if_version("user1.json", "stale", version))
+            self.assertEqual(store.get("user1.json"), "second")
+
+    def test_s3_put_if_version(self):
+        """Test S3 writes are conditioned on the ETag and a failed precondition is reported"""
+        s3 = MagicMock()
+        store = S3Store("bucket", "index/", s3=s3)
+
+        self.assertTrue(store.put_if_version("user1.json", "value", '"etag1"'))
+        self.assertEqual(s3.put_object.call_args.kwargs['IfMatch'], '"etag1"')
+        store.put_if_version("user1.json", "value", None)
+        self.assertEqual(s3.put_object.call_args.kwargs['IfNoneMatch'], '*')
+
+        s3.put_object.side_effect = ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        self.assertFalse(store.put_if_version("user1.json", "value", '"etag1"'))
+
+if __name__ == '__main__':
+    unittest.main(verbose=2)
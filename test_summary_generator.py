@@ -0,0 +1,242 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import tempfile
+import summary_generator
+from summary_generator import (
+    GeminiClient,
+    generate_hierarchical_summary,
+    generate_summary,
+    lambda_handler,
+    split_text_sections,
+    split_transcript_sections,
+    summarize_transcript,
+)
+from kv_store import LocalFileStore
+from test_chapter_generator import CaptureOutput
+
+def make_items(words_with_times):
+    items = []
+    for word, start in words_with_times:
+        items.append({"type": "pronunciation", "start_time": str(start), "end_time": str(start + 0.5),
+                      "alternatives": [{"content": word}]})
+        if word.endswith("!"):
+            items[-1]["alternatives"][0]["content"] = word[:-1]
+            items.append({"type": "punctuation", "alternatives": [{"content": "!"}]})
+    return items
+
+class TestSummaryGeneration(unittest.TestCase):
+    def setUp(self):
+        # Mock environment variables
+        self.env_patcher = patch.dict('os.environ', {
+            'GEMINI_API_KEY': 'test_api_key',
+            'GEMINI_MODEL_NAME': 'test_model'
+        })
+        self.env_patcher.start()
+        
+        self.sample_transcript = "Welcome to this video about Python programming. Today we'll learn about functions and classes."
+        
+    def tearDown(self):
+        self.env_patcher.stop()
+
+    @patch.object(GeminiClient, 'generate_content')
+    def test_generate_summary_inline(self, mock_generate_content):
+        """Test summaries include the transcript when no cache is given"""
+        mock_generate_content.return_value = "A video about Python."
+        
+        result = generate_summary(self.sample_transcript, 'short')
+        
+        self.assertEqual(result, "A video about Python.")
+        self.assertIn(self.sample_transcript, mock_generate_content.call_args[0][0])
+
+    @patch.object(GeminiClient, 'generate_content')
+    def test_generate_summary_with_cached_context(self, mock_generate_content):
+        """Test summaries reuse the cached transcript instead of resending it"""
+        mock_generate_content.return_value = "A detailed summary."
+        
+        generate_summary(self.sample_transcript, 'long', cached_content="cachedContents/abc")
+        
+        prompt = mock_generate_content.call_args[0][0]
+        self.assertNotIn(self.sample_transcript, prompt)
+        self.assertIn("4-6 paragraphs", prompt)
+        self.assertEqual(mock_generate_content.call_args.kwargs['cached_content'], "cachedContents/abc")
+
+    @patch.object(GeminiClient, 'generate_content')
+    def test_generate_summary_expired_cache(self, mock_generate_content):
+        """Test an expired cache falls back to sending the transcript inline"""
+        mock_generate_content.side_effect = [Exception("Cache expired"), "A video about Python."]
+        
+        with CaptureOutput():
+            result = generate_summary(self.sample_transcript, 'short', cached_content="cachedContents/abc")
+        
+        self.assertEqual(result, "A video about Python.")
+        self.assertIn(self.sample_transcript, mock_generate_content.call_args[0][0])
+        self.assertNotIn('cached_content', mock_generate_content.call_args.kwargs)
+
+    @patch.object(GeminiClient, 'generate_content')
+    def test_generate_summary_error(self, mock_generate_content):
+        """Test summary generation error handling"""
+        mock_generate_content.side_effect = Exception("API Error")
+        
+        with CaptureOutput() as output:
+            result = generate_summary(self.sample_transcript, 'long')
+        
+        self.assertEqual(result, "Error generating long summary.")
+        self.assertIn("Error generating long summary: API Error", output.stdout.getvalue())
+
+class TestHierarchicalSummary(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = LocalFileStore(self.tmp.name)
+        self.gemini = MagicMock()
+        self.gemini.model_name = "test_model"
+        self.gemini.generate_content.side_effect = lambda prompt: f"summary {len(prompt)}"
+        
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_split_transcript_sections(self):
+        """Test items are grouped into fixed time windows"""
+        items = make_items([("Hello", 0), ("there!", 30), ("Middle", 650), ("End", 1900)])
+        
+        sections = split_transcript_sections(items, section_seconds=600)
+        
+        self.assertEqual(sections, [
+            {"start": 0, "text": "Hello there!"},
+            {"start": 600, "text": "Middle"},
+            {"start": 1800, "text": "End"},
+        ])
+
+    def test_split_text_sections_is_local(self):
+        """Test an edit to plain text only changes the sections around it"""
+        text = " ".join(f"Sentence number {i} talks about topic {i % 7}." for i in range(2000))
+        edited = text.replace("Sentence number 1000 talks", "Sentence number 1000 now talks")
+        
+        original_sections = [section["text"] for section in split_text_sections(text)]
+        edited_sections = [section["text"] for section in split_text_sections(edited)]
+        
+        self.assertGreater(len(original_sections), 5)
+        changed = set(edited_sections) - set(original_sections)
+        self.assertLessEqual(len(changed), 2)
+
+    def test_rerun_only_resummarises_changed_sections(self):
+        """Test memoisation reuses unchanged section summaries after an edit"""
+        sections = [{"start": i * 600, "text": f"Section {i} text."} for i in range(5)]
+        
+        generate_hierarchical_summary(sections, 'long', gemini=self.gemini, store=self.store)
+        self.assertEqual(self.gemini.generate_content.call_count, 6)  # 5 sections + reduction
+        
+        self.gemini.generate_content.reset_mock()
+        generate_hierarchical_summary(sections, 'long', gemini=self.gemini, store=self.store)
+        self.assertEqual(self.gemini.generate_content.call_count, 0)
+        
+        sections[2] = {"start": 1200, "text": "Section 2 text, edited."}
+        generate_hierarchical_summary(sections, 'long', gemini=self.gemini, store=self.store)
+        self.assertEqual(self.gemini.generate_content.call_count, 2)  # changed section + reduction
+
+    def test_short_summary_derived_from_long(self):
+        """Test the short summary is generated from the reduced long summary"""
+        sections = [{"start": 0, "text": "Only section."}]
+        long_summary = generate_hierarchical_summary(sections, 'long', gemini=self.gemini, store=self.store)
+        
+        self.gemini.generate_content.reset_mock()
+        generate_hierarchical_summary(sections, 'short', gemini=self.gemini, store=self.store)
+        
+        self.gemini.generate_content.assert_called_once()
+        self.assertIn(long_summary, self.gemini.generate_content.call_args[0][0])
+
+    @patch.object(summary_generator, 'HIERARCHICAL_SUMMARY_MIN_CHARS', 10)
+    def test_long_transcripts_use_hierarchical_mode(self):
+        """Test transcripts above the threshold are summarised by section"""
+        items = make_items([("Hello", 0), ("world", 700)])
+        
+        with CaptureOutput():
+            summarize_transcript("Hello world and more", 'long', gemini=self.gemini, items=items, store=self.store)
+        
+        # Two sections plus the reduction, and no single prompt with the full transcript
+        self.assertEqual(self.gemini.generate_content.call_count, 3)
+
+    def test_single_prompt_failure_falls_back(self):
+        """Test a failing single prompt is retried hierarchically instead of storing an error"""
+        responses = iter([Exception("Context window exceeded"), "section summary", "long summary"])
+        
+        def generate(prompt, **kwargs):
+            response = next(responses)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        self.gemini.generate_content.side_effect = generate
+        
+        with CaptureOutput():
+            result = summarize_transcript("A short transcript.", 'long', gemini=self.gemini, store=self.store)
+        
+        self.assertEqual(result, "long summary")
+
+class TestSummaryLambdaHandler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store_patcher = patch('summary_generator.get_stage_state_store',
+                                   return_value=LocalFileStore(self.tmp.name))
+        self.store_patcher.start()
+        self.event = {"detail": {"user_id": "user1", "video_id": "video1",
+                                 "transcript_text": "Hello world.", "summary_type": "short"}}
+        
+    def tearDown(self):
+        self.store_patcher.stop()
+        self.tmp.cleanup()
+
+    @patch('summary_generator.update_summary')
+    @patch('summary_generator.summarize_transcript', return_value="A greeting.")
+    def test_redelivered_event_is_skipped(self, mock_summarize, mock_update_summary):
+        """Test a summary already saved is not regenerated on retry"""
+        with CaptureOutput():
+            lambda_handler(self.event, None)
+            lambda_handler(self.event, None)
+        
+        mock_summarize.assert_called_once()
+        mock_update_summary.assert_called_once_with("user1", "video1", "A greeting.", "short")
+
+    @patch('summary_generator.update_summary')
+    @patch('summary_generator.summarize_transcript')
+    def test_concurrent_summaries_keep_both_records(self, mock_summarize, mock_update_summary):
+        """Test short and long summary Lambdas running at once do not erase each other's progress"""
+        long_event = {"detail": dict(self.event["detail"], summary_type="long")}
+        
+        def summarize(text, summary_type, **kwargs):
+            # The long summary Lambda finishes while the short one is still generating
+            if summary_type == 'short':
+                lambda_handler(long_event, None)
+            return f"{summary_type} summary"
+        mock_summarize.side_effect = summarize
+        
+        with CaptureOutput():
+            lambda_handler(self.event, None)
+            lambda_handler(long_event, None)
+            lambda_handler(self.event, None)
+        
+        self.assertEqual(mock_summarize.call_count, 2)
+        self.assertEqual(mock_update_summary.call_count, 2)
+
+    @patch('summary_generator.get_summary_store')
+    @patch('summary_generator.update_summary')
+    @patch('summary_generator.GeminiClient')
+    def test_both_event_reduces_once(self, mock_gemini_class, mock_update_summary, mock_get_summary_store):
+        """Test one hierarchical invocation writes both summaries from a single reduction"""
+        mock_get_summary_store.return_value = LocalFileStore(f"{self.tmp.name}/summaries")
+        gemini = mock_gemini_class.return_value
+        gemini.model_name = "test_model"
+        gemini.generate_content.side_effect = lambda prompt: "short" if "1-2 sentence" in prompt else "long"
+        event = {"detail": dict(self.event["detail"], summary_type="both",
+                                transcript_text=" ".join(f"Sentence {i}." for i in range(3000)))}
+        
+        with CaptureOutput():
+            lambda_handler(event, None)
+            lambda_handler(event, None)
+        
+        prompts = [call.args[0] for call in gemini.generate_content.call_args_list]
+        self.assertEqual(sum("Combine them" in prompt for prompt in prompts), 1)
+        self.assertEqual(sum("1-2 sentence" in prompt for prompt in prompts), 1)
+        self.assertEqual([call.args[2:] for call in mock_update_summary.call_args_list],
+                         [("short", "short"), ("long", "long")])
+
+if __name__ == '__main__':
+    unittest.main(verbose=2)
@@ -0,0 +1,199 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import json
+import os
+import tempfile
+import threading
+import time
+from chapter_generator import route_to_worker
+from job_queue import InMemoryQueue, QueueMessage, open_queue
+from kv_store import LocalFileStore
+from pipeline import LocalStorage
+from worker import MessageLease, PipelineWorker
+from test_batch_reprocess import SAMPLE_TRANSCRIPT
+from test_chapter_generator import CaptureOutput
+
+TRANSCRIPT_KEY = "transcripts/transcribe_user1_video1_1700000000.json"
+
+class TestPipelineWorker(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.storage = LocalStorage(os.path.join(self.tmp.name, "bucket"))
+        self.storage.write_text(TRANSCRIPT_KEY, json.dumps(SAMPLE_TRANSCRIPT))
+        self.checkpoints = LocalFileStore(os.path.join(self.tmp.name, "checkpoints"))
+        self.queue = InMemoryQueue()
+        self.gemini = MagicMock()
+        self.gemini.generate_content.return_value = "00:00 Greeting"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_worker(self, **kwargs):
+        return PipelineWorker(
+            self.queue,
+            gemini=self.gemini,
+            checkpoint_store=self.checkpoints,
+            summary_store=LocalFileStore(os.path.join(self.tmp.name, "summaries")),
+            storage_factory=lambda bucket: self.storage,
+            max_workers=2,
+            poll_seconds=0,
+            update_db=False,
+            **kwargs
+        )
+
+    def test_processes_job(self):
+        """Test a job runs every stage, writes outputs and is removed from the queue"""
+        self.queue.send({"bucket": "bucket", "key": TRANSCRIPT_KEY})
+
+        with CaptureOutput():
+            self.make_worker().run(exit_when_idle=True)
+
+        self.assertEqual(self.gemini.generate_content.call_count, 3)
+        self.assertEqual(self.storage.read_text("chapters/user1/video1_chapters.txt"), "00:00 Greeting")
+        self.assertEqual(self.queue.pending_count(), 0)
+        self.assertEqual(self.queue.in_flight_count(), 0)
+        self.assertIsNone(self.checkpoints.get("transcribe_user1_video1_1700000000.json"))
+
+    @patch('summary_generator.HIERARCHICAL_SUMMARY_MIN_CHARS', 5)
+    @patch('worker.create_transcript_context', return_value="cachedContents/abc")
+    def test_hierarchical_job_skips_cached_context(self, mock_create_context):
+        """Test a job whose summaries are hierarchical does not cache a context only chapters would read"""
+        self.queue.send({"bucket": "bucket", "key": TRANSCRIPT_KEY})
+
+        with CaptureOutput():
+            self.make_worker().run(exit_when_idle=True)
+
+        mock_create_context.assert_not_called()
+        self.assertEqual(self.queue.in_flight_count(), 0)
+
+    def test_stop_checkpoints_and_releases(self):
+        """Test SIGTERM mid-job releases the message and a new worker resumes at the next stage"""
+        self.queue.send({"bucket": "bucket", "key": TRANSCRIPT_KEY})
+        worker = self.make_worker()
+
+        def generate_then_stop(prompt, **kwargs):
+            worker.request_stop()
+            return "00:00 Greeting"
+        self.gemini.generate_content.side_effect = generate_then_stop
+
+        with CaptureOutput():
+            worker.run(exit_when_idle=True)
+
+        self.assertEqual(self.gemini.generate_content.call_count, 1)
+        self.assertEqual(self.queue.pending_count(), 1)
+        checkpoint = json.loads(self.checkpoints.get("transcribe_user1_video1_1700000000.json"))
+        self.assertEqual(checkpoint["completed"], ["chapters"])
+
+        self.gemini.generate_content.reset_mock()
+        self.gemini.generate_content.side_effect = None
+        with CaptureOutput():
+            self.make_worker().run(exit_when_idle=True)
+
+        # Only the short and long summaries are generated on resume
+        self.assertEqual(self.gemini.generate_content.call_count, 2)
+        self.assertEqual(self.queue.pending_count(), 0)
+        self.assertEqual(self.queue.in_flight_count(), 0)
+
+    def test_running_stage_released_after_stop_grace(self):
+        """Test a stage still running when the stop grace period ends has its job released before the task is killed"""
+        self.queue.send({"bucket": "bucket", "key": TRANSCRIPT_KEY})
+        worker = self.make_worker(stop_grace_seconds=0)
+
+        def generate_until_released(prompt, **kwargs):
+            worker.request_stop()
+            deadline = time.time() + 5
+            while self.queue.pending_count() == 0 and time.time() < deadline:
+                time.sleep(0.05)
+            return "00:00 Greeting"
+        self.gemini.generate_content.side_effect = generate_until_released
+
+        with CaptureOutput() as output:
+            worker.run(exit_when_idle=True)
+
+        self.assertIn("did not finish before shutdown", output.stdout.getvalue())
+        self.assertEqual(self.queue.pending_count(), 1)
+        self.assertEqual(self.queue.in_flight_count(), 0)
+        checkpoint = json.loads(self.checkpoints.get("transcribe_user1_video1_1700000000.json"))
+        self.assertEqual(checkpoint["completed"], ["chapters"])
+
+    def test_failed_job_stays_in_flight(self):
+        """Test a failing job is not deleted, so the queue redelivers it after the visibility timeout"""
+        self.queue.send({"bucket": "bucket", "key": TRANSCRIPT_KEY})
+        self.gemini.generate_content.side_effect = Exception("API Error")
+
+        with CaptureOutput() as output:
+            self.make_worker().run(exit_when_idle=True)
+
+        self.assertEqual(self.queue.in_flight_count(), 1)
+        self.assertIn("failed", output.stdout.getvalue())
+
+    def test_checkpoint_cleanup_failure_still_acknowledges(self):
+        """Test a checkpoint that cannot be deleted is logged and the finished job is still removed"""
+        self.queue.send({"bucket": "bucket", "key": TRANSCRIPT_KEY})
+        self.checkpoints.delete = MagicMock(side_effect=Exception("AccessDenied"))
+
+        with CaptureOutput() as output:
+            self.make_worker().run(exit_when_idle=True)
+
+        self.assertEqual(self.queue.pending_count(), 0)
+        self.assertEqual(self.queue.in_flight_count(), 0)
+        self.assertIn("Could not delete checkpoint", output.stdout.getvalue())
+
+class TestMessageLease(unittest.TestCase):
+    def setUp(self):
+        self.queue = MagicMock()
+        self.message = QueueMessage("message1", {}, "receipt1")
+        self.stopping = threading.Event()
+
+    def test_heartbeat_extends_visibility(self):
+        """Test a running job keeps its message hidden and a finished one is acknowledged once"""
+        with MessageLease(self.queue, self.message, self.stopping, visibility_seconds=0.3, tick_seconds=0.02) as lease:
+            time.sleep(0.35)
+            self.assertTrue(lease.acknowledge())
+
+        self.assertGreaterEqual(self.queue.extend.call_count, 2)
+        self.queue.extend.assert_called_with(self.message, 0.3)
+        self.queue.delete.assert_called_once_with(self.message)
+        self.queue.release.assert_not_called()
+
+    def test_released_message_is_not_acknowledged(self):
+        """Test a job finishing after its message was released does not delete the redelivered message"""
+        with MessageLease(self.queue, self.message, self.stopping, stop_grace_seconds=0, tick_seconds=0.02) as lease:
+            with CaptureOutput():
+                self.stopping.set()
+                time.sleep(0.1)
+            self.assertTrue(lease.released)
+            self.assertFalse(lease.acknowledge())
+            self.assertFalse(lease.release())
+
+        self.queue.release.assert_called_once_with(self.message)
+        self.queue.delete.assert_not_called()
+
+class TestWorkerRouting(unittest.TestCase):
+    @patch('chapter_generator.open_queue')
+    def test_route_heavy_transcript(self, mock_open_queue):
+        """Test only transcripts above the size threshold are queued"""
+        queue = InMemoryQueue()
+        mock_open_queue.return_value = queue
+
+        with CaptureOutput():
+            self.assertFalse(route_to_worker("bucket", TRANSCRIPT_KEY, 1024))
+            self.assertTrue(route_to_worker("bucket", TRANSCRIPT_KEY, 50 * 1024 * 1024))
+
+        message = queue.receive()[0]
+        self.assertEqual(message.body["key"], TRANSCRIPT_KEY)
+        self.assertEqual(message.body["stages"], ["chapters", "short_summary", "long_summary"])
+
+    @patch('chapter_generator.open_queue', return_value=None)
+    def test_no_queue_configured(self, mock_open_queue):
+        """Test transcripts are processed in Lambda when no worker queue exists"""
+        self.assertFalse(route_to_worker("bucket", TRANSCRIPT_KEY, 50 * 1024 * 1024))
+
+    @patch.dict('os.environ', {'WORKER_QUEUE_URL': ''})
+    def test_empty_queue_url_disables_routing(self):
+        """Test the empty queue URL set when no worker service is deployed keeps transcripts in Lambda"""
+        self.assertIsNone(open_queue())
+        self.assertFalse(route_to_worker("bucket", TRANSCRIPT_KEY, 50 * 1024 * 1024))
+
+if __name__ == '__main__':
+    unittest.main(verbose=2)
@@ -23,6 +23,18 @@ variable "gemini_model_name" {
   type        = string
 }
 
+variable "pipeline_worker_image" {
+  description = "Container image (with tag) running worker.py; the pipeline worker service is only created when set"
+  type        = string
+  default     = ""
+}
+
+variable "ffmpeg_layer_arn" {
+  description = "Lambda layer providing /opt/bin/ffmpeg for upload fingerprinting; deduplication is skipped when unset"
+  type        = string
+  default     = ""
+}
+
 variable "supabase_url" {
   description = "Supabase project URL"
   type        = string
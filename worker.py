@@ -0,0 +1,305 @@
+"""
+Long-running pipeline worker for the ECS service.
+
+Consumes pipeline jobs ({"bucket": ..., "key": "transcripts/...json"}) from the queue at
+WORKER_QUEUE_URL and runs the chapter and summary stages with warm Gemini, S3 and Supabase
+clients in a thread pool. The chapter generator Lambda routes transcripts above
+WORKER_ROUTING_MIN_BYTES here instead of processing them itself.
+
+Completed stages are checkpointed per job. While a job runs, a heartbeat keeps extending its
+message's visibility timeout, so a long job is never delivered to a second task. On SIGTERM
+(Fargate Spot interruption) the worker stops taking new jobs and releases every unfinished
+job back to the queue at its next stage boundary, so another task resumes it from the next
+stage. A job whose stage is still running when the stop grace period ends is released
+anyway, before the task is killed, and resumes from its last completed stage.
+
+Usage:
+    WORKER_QUEUE_URL=https://sqs... python worker.py
+"""
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from gemini_client import GeminiClient
+from chapter_generator import context_cache_readers, create_transcript_context, parse_transcript_key
+from summary_generator import get_summary_store
+from job_queue import PIPELINE_STAGES, open_queue
+from kv_store import open_store
+from pipeline import S3Storage, prepare_transcript, run_chapters_stage, run_summary_stage
+
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "4"))
+WORKER_CHECKPOINT_LOCATION = os.environ.get("WORKER_CHECKPOINT_LOCATION", "/tmp/worker_checkpoints")
+# Seconds to long-poll the queue when idle
+WORKER_POLL_SECONDS = int(os.environ.get("WORKER_POLL_SECONDS", "20"))
+# Visibility timeout kept on a running job's message, renewed every third of it
+WORKER_VISIBILITY_SECONDS = int(os.environ.get("WORKER_VISIBILITY_SECONDS", "600"))
+# How long running stages get after SIGTERM before their jobs are released anyway.
+# Must stay below the task definition's stopTimeout (120 s), after which the task is killed.
+WORKER_STOP_GRACE_SECONDS = int(os.environ.get("WORKER_STOP_GRACE_SECONDS", "90"))
+
+def job_id_for(job):
+    """Stable identifier for a job, so a redelivered message finds its checkpoint."""
+    return job.get('job_id') or os.path.splitext(os.path.basename(job['key']))[0]
+
+class MessageLease:
+    """
+    Holds a received message for the job processing it.
+
+    A heartbeat thread extends the message's visibility timeout while the job runs. Once the
+    worker is stopping, it waits up to stop_grace_seconds for the job to finish or reach a
+    stage boundary and then releases the message itself. Release and acknowledgement each
+    happen at most once and exclude each other, so a stage finishing after the release
+    cannot delete a message another task has received.
+    """
+
+    def __init__(self, queue, message, stopping, visibility_seconds=WORKER_VISIBILITY_SECONDS,
+                 stop_grace_seconds=WORKER_STOP_GRACE_SECONDS, tick_seconds=1.0):
+        self.queue = queue
+        self.message = message
+        self.stopping = stopping
+        self.visibility_seconds = visibility_seconds
+        self.stop_grace_seconds = stop_grace_seconds
+        self.tick_seconds = tick_seconds
+        self.released = False
+        self.acknowledged = False
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._finished.set()
+        self._thread.join()
+
+    def _heartbeat(self):
+        extend_every = self.visibility_seconds / 3
+        next_extend = time.time() + extend_every
+        stop_deadline = None
+        while not self._finished.wait(self.tick_seconds):
+            now = time.time()
+            if self.stopping.is_set():
+                stop_deadline = stop_deadline or now + self.stop_grace_seconds
+                if now >= stop_deadline:
+                    if self.release():
+                        print(f"Released message {self.message.message_id}: its stage did not finish before shutdown")
+                    return
+            if now >= next_extend:
+                try:
+                    self.queue.extend(self.message, self.visibility_seconds)
+                except Exception as e:
+                    print(f"Could not extend visibility of message {self.message.message_id}: {str(e)}")
+                next_extend = now + extend_every
+
+    def release(self):
+        """Return the message to the queue. Returns False if it was already released or acknowledged."""
+        with self._lock:
+            if self.released or self.acknowledged:
+                return False
+            self.released = True
+        self.queue.release(self.message)
+        return True
+
+    def acknowledge(self):
+        """Delete the message. Returns False if it was already released."""
+        with self._lock:
+            if self.released:
+                return False
+            self.acknowledged = True
+        self.queue.delete(self.message)
+        return True
+
+class PipelineWorker:
+    """Queue consumer that runs pipeline stages for each job with shared clients."""
+
+    def __init__(self, queue, gemini=None, checkpoint_store=None, summary_store=None, storage_factory=S3Storage,
+                 max_workers=WORKER_THREADS, poll_seconds=WORKER_POLL_SECONDS, update_db=True,
+                 visibility_seconds=WORKER_VISIBILITY_SECONDS, stop_grace_seconds=WORKER_STOP_GRACE_SECONDS):
+        """
+        Args:
+            queue: SQSQueue or InMemoryQueue to consume
+            gemini: Optional GeminiClient shared by all jobs
+            checkpoint_store: Key/value store for per-job stage checkpoints
+            summary_store: Store for memoised hierarchical summaries
+            storage_factory: Callable taking a bucket name and returning a storage backend
+            max_workers: Number of jobs processed concurrently
+            poll_seconds: Long-poll wait when the queue is empty
+            update_db: Whether to write results to Supabase
+            visibility_seconds: Visibility timeout kept on the message of a running job
+            stop_grace_seconds: Time running stages get after a stop request before their jobs are released
+        """
+        self.queue = queue
+        self.gemini = gemini or GeminiClient()
+        self.checkpoint_store = checkpoint_store if checkpoint_store is not None else open_store(WORKER_CHECKPOINT_LOCATION)
+        self.summary_store = summary_store if summary_store is not None else get_summary_store()
+        self.storage_factory = storage_factory
+        self.max_workers = max_workers
+        self.poll_seconds = poll_seconds
+        self.update_db = update_db
+        self.visibility_seconds = visibility_seconds
+        self.stop_grace_seconds = stop_grace_seconds
+        self.stopping = threading.Event()
+        self._storages = {}
+        self._storages_lock = threading.Lock()
+
+    def request_stop(self, signum=None, frame=None):
+        """
+        Signal handler: stop receiving jobs and release unfinished ones at the next stage boundary,
+        or after stop_grace_seconds if a stage is still running then.
+        """
+        print(f"Received signal {signum}, checkpointing in-flight jobs and shutting down")
+        self.stopping.set()
+
+    def storage_for(self, bucket):
+        with self._storages_lock:
+            if bucket not in self._storages:
+                self._storages[bucket] = self.storage_factory(bucket)
+            return self._storages[bucket]
+
+    def load_checkpoint(self, job_id):
+        stored = self.checkpoint_store.get(f"{job_id}.json")
+        if stored is None:
+            return {'completed': [], 'cached_content': None}
+        return json.loads(stored)
+
+    def save_checkpoint(self, job_id, checkpoint):
+        self.checkpoint_store.put(f"{job_id}.json", json.dumps(checkpoint))
+
+    def run_stage(self, stage, storage, transcript_json, user_id, video_id, cached_content):
+        if stage == 'chapters':
+            run_chapters_stage(storage, transcript_json, user_id, video_id, gemini=self.gemini,
+                               cached_content=cached_content, update_db=self.update_db)
+        else:
+            summary_type = stage[:-len('_summary')]
+            run_summary_stage(transcript_json, user_id, video_id, summary_type, gemini=self.gemini,
+                              cached_content=cached_content, store=self.summary_store, update_db=self.update_db)
+
+    def process_message(self, message):
+        """
+        Run the remaining stages of one job.
+
+        Returns:
+            str: 'done' (message deleted), 'released' (stopped early, message returned to the
+            queue) or 'failed' (message left to reappear after its visibility timeout)
+        """
+        with MessageLease(self.queue, message, self.stopping, self.visibility_seconds,
+                          self.stop_grace_seconds) as lease:
+            return self._run_job(message, lease)
+
+    def _run_job(self, message, lease):
+        job = message.body
+        job_id = job_id_for(job)
+        checkpoint = self.load_checkpoint(job_id)
+        stages = job.get('stages') or list(PIPELINE_STAGES)
+
+        try:
+            storage = self.storage_for(job['bucket'])
+            user_id, video_id = parse_transcript_key(job['key'])
+            transcript_json = json.loads(storage.read_text(job['key']))
+
+            remaining = [stage for stage in stages if stage not in checkpoint['completed']]
+            summary_stages = [stage for stage in remaining if stage != 'chapters']
+            readers = context_cache_readers(transcript_json['results']['transcripts'][0]['transcript'],
+                                            chapters='chapters' in remaining, summaries=len(summary_stages))
+            if readers > 1 and not checkpoint.get('cached_content'):
+                _, detailed_transcript_text, _ = prepare_transcript(transcript_json)
+                checkpoint['cached_content'] = create_transcript_context(detailed_transcript_text, gemini=self.gemini)
+
+            for stage in remaining:
+                if self.stopping.is_set() or lease.released:
+                    self.save_checkpoint(job_id, checkpoint)
+                    lease.release()
+                    print(f"Released job {job_id} after {checkpoint['completed'] or 'no stages'}")
+                    return 'released'
+
+                print(f"Job {job_id}: running {stage}")
+                self.run_stage(stage, storage, transcript_json, user_id, video_id, checkpoint['cached_content'])
+                checkpoint['completed'].append(stage)
+                self.save_checkpoint(job_id, checkpoint)
+
+        except Exception as e:
+            print(f"Job {job_id} failed: {str(e)}")
+            self.save_checkpoint(job_id, checkpoint)
+            return 'failed'
+
+        if lease.released:
+            # Released while the last stage ran; the task that receives it next finds every
+            # stage checkpointed and only cleans up
+            print(f"Job {job_id} finished after its message was released")
+            return 'released'
+
+        if checkpoint.get('cached_content'):
+            try:
+                self.gemini.delete_cached_context(checkpoint['cached_content'])
+            except Exception:
+                pass  # The cache expires on its own TTL
+        try:
+            self.checkpoint_store.delete(f"{job_id}.json")
+        except Exception as e:
+            # A leftover checkpoint lists every stage as completed, so a redelivery is a no-op
+            print(f"Could not delete checkpoint for job {job_id}: {str(e)}")
+        try:
+            lease.acknowledge()
+        except Exception as e:
+            print(f"Could not acknowledge job {job_id}: {str(e)}")
+            return 'failed'
+        print(f"Job {job_id} complete")
+        return 'done'
+
+    def run(self, exit_when_idle=False):
+        """
+        Consume jobs until request_stop is called.
+
+        Args:
+            exit_when_idle: Return once the queue is empty and no job is running (for local runs and tests)
+        """
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while not self.stopping.is_set():
+                in_flight = {future for future in in_flight if not future.done()}
+                free_slots = self.max_workers - len(in_flight)
+                if free_slots <= 0:
+                    wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+                    continue
+
+                messages = self.queue.receive(free_slots, self.poll_seconds)
+                if self.stopping.is_set():
+                    for message in messages:
+                        self.queue.release(message)
+                    break
+
+                if not messages:
+                    if not in_flight and exit_when_idle:
+                        break
+                    wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+
+                for message in messages:
+                    in_flight.add(executor.submit(self.process_message, message))
+
+            # Running jobs notice the stop flag at their next stage boundary, and their leases
+            # release them after the stop grace period if a stage is still running
+            wait(in_flight)
+
+def main():
+    queue = open_queue()
+    if queue is None:
+        print("WORKER_QUEUE_URL is not set")
+        return 1
+
+    worker = PipelineWorker(queue)
+    signal.signal(signal.SIGTERM, worker.request_stop)
+    signal.signal(signal.SIGINT, worker.request_stop)
+
+    print(f"Pipeline worker started with {worker.max_workers} threads on {queue.queue_url}")
+    worker.run()
+    print("Pipeline worker stopped")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())